@@ -0,0 +1,18 @@
+from mmengine.config import read_base
+from src.datasets.collate_functions import (collate_func_gen_packed,
+                                            collate_func_und_packed, CollateConcat)
+
+with read_base():
+    from .image2text_text2image import *   #
+
+
+# padding-free batches, to be trained with model.update(use_varlen_attn=True),
+# see configs/examples/qwen2_5_0_5b_kl16_mar_b_packed_train.py
+train_dataloader.update(
+    collate_fn=dict(type=CollateConcat,
+                    collate_fns=[dict(type=collate_func_und_packed),
+                                 dict(type=collate_func_gen_packed),
+                                 ],
+                    keys=group_keys
+                    )
+)
@@ -0,0 +1,46 @@
+from src.datasets.text2image.text2image import CachedLatentText2ImageDataset
+from mmengine.config import read_base
+from src.datasets.collate_functions import collate_func_gen, CollateConcat
+from src.datasets.samplers.multi_source_sampler import FixedBatchMultiSourceSampler
+
+with read_base():
+    from .processors import prompt_template, tokenizer, image_size, pad_index
+
+
+max_length = 128
+
+
+# latents of text2image.py, cached with
+#   accelerate launch scripts/cache_latents.py configs/datasets/qwen2_5_0_5b/text2image.py \
+#       --output_dir data/laion8m/laion6m_shortcaps_latents --flip
+dataset = dict(type=CachedLatentText2ImageDataset,
+               data_path='data/laion8m/laion6m_shortcaps_latents',
+               random_flip=True,
+               unconditional=0.1,
+               prompt_template=prompt_template,
+               tokenizer=tokenizer,
+               max_length=max_length)
+
+
+group_keys = ['text2image']
+repeat = [1,]
+batch_size = 32
+train_dataloader = dict(
+    batch_size=batch_size,
+    num_workers=4,
+    prefetch_factor=1,
+    persistent_workers=False,
+    pin_memory=True,
+    dataset=dataset,
+    sampler=dict(type=FixedBatchMultiSourceSampler,
+                 repeat=repeat,
+                 batch_size=batch_size,    # fixed batch size for all sources
+                 shuffle=True),
+    collate_fn=dict(type=CollateConcat,
+                    collate_fns=[
+                                 dict(type=collate_func_gen,
+                                      pad_index=pad_index),
+                                 ],
+                    keys=group_keys
+                    )
+)
@@ -0,0 +1,9 @@
+from mmengine.config import read_base
+
+with read_base():
+    from .qwen2_5_0_5b_kl16_mar_b_train import *   #
+    from ..datasets.qwen2_5_0_5b.image2text_text2image_packed import train_dataloader
+
+
+# padding-free packed batches, kept apart by the varlen attention of flash_attention_2
+model.update(use_varlen_attn=True)
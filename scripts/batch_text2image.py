@@ -11,6 +11,9 @@ from accelerate.utils import gather_object
 from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 from einops import rearrange
+from functools import partial
+from src.models.cache_utils import PrefixKVCache
+from src.models.async_decode import AsyncDecoder
 
 
 class JsonDataset(Dataset):
@@ -43,6 +46,14 @@ if __name__ == '__main__':
     parser.add_argument('--num_iter', type=int, default=64)
     parser.add_argument('--image_size', type=int, default=512)
     parser.add_argument('--grid_size', type=int, default=2)
+    parser.add_argument('--prefix_cache_mb', type=float, default=0,
+                        help='memory budget of the cross-prompt KV prefix cache (0 disables it)')
+    parser.add_argument('--prefix_cache_dir', type=str, default=None,
+                        help='spill prefix cache entries evicted from memory to this folder')
+    parser.add_argument('--decode_batch_size', type=int, default=None,
+                        help='VAE-decode in micro-batches of this many images')
+    parser.add_argument('--async_decode', action='store_true',
+                        help='decode and save on a worker thread, overlapped with the next batch')
     args = parser.parse_args()
 
     accelerator = Accelerator()
@@ -72,6 +83,9 @@ if __name__ == '__main__':
     model = model.to(device=accelerator.device)
     model = model.to(model.dtype)
     model.eval()
+    prefix_cache = None
+    if args.prefix_cache_mb > 0:
+        prefix_cache = PrefixKVCache(max_bytes=int(args.prefix_cache_mb * 2 ** 20), disk_dir=args.prefix_cache_dir)
 
     dataloader = accelerator.prepare(dataloader)
 
@@ -81,6 +95,21 @@ if __name__ == '__main__':
     if accelerator.is_main_process:
         os.makedirs(args.output, exist_ok=True)
 
+    def save(images, data_samples):
+        images = rearrange(images, '(m n b) c h w -> b (m h) (n w) c', m=args.grid_size, n=args.grid_size)
+
+        images = torch.clamp(
+            127.5 * images + 128.0, 0, 255).to("cpu", dtype=torch.uint8).numpy()
+
+        # Save samples to disk as individual .png files
+        for image, data_sample in zip(images, data_samples):
+            sample_id = data_sample['sample_id']
+            with open(f"{args.output}/{sample_id:08d}.json", "w") as f:
+                json.dump(obj=data_sample, fp=f)
+            Image.fromarray(image).save(f"{args.output}/{sample_id:08d}.jpg")
+
+    decoder = AsyncDecoder(model, batch_size=args.decode_batch_size) if args.async_decode else None
+
     for batch_idx, data_samples in tqdm(enumerate(dataloader), disable=not accelerator.is_main_process):
         device_idx = accelerator.process_index
 
@@ -96,16 +125,17 @@ if __name__ == '__main__':
         inputs = model.tokenizer(
             prompts, add_special_tokens=True, return_tensors='pt', padding=True).to(accelerator.device)
 
-        images = model.sample(**inputs, num_iter=args.num_iter, cfg=args.cfg, cfg_schedule=args.cfg_schedule,
-                              temperature=args.temperature, progress=False, image_shape=(m, n))
-        images = rearrange(images, '(m n b) c h w -> b (m h) (n w) c', m=args.grid_size, n=args.grid_size)
-
-        images = torch.clamp(
-            127.5 * images + 128.0, 0, 255).to("cpu", dtype=torch.uint8).numpy()
-
-        # Save samples to disk as individual .png files
-        for image, data_sample in zip(images, data_samples):
-            sample_id = data_sample['sample_id']
-            with open(f"{args.output}/{sample_id:08d}.json", "w") as f:
-                json.dump(obj=data_sample, fp=f)
-            Image.fromarray(image).save(f"{args.output}/{sample_id:08d}.jpg")
+        sample_kwargs = dict(num_iter=args.num_iter, cfg=args.cfg, cfg_schedule=args.cfg_schedule,
+                             temperature=args.temperature, progress=False, image_shape=(m, n),
+                             prefix_cache=prefix_cache)
+        if decoder is None:
+            images = model.sample(**inputs, **sample_kwargs, decode_batch_size=args.decode_batch_size)
+            save(images, data_samples)
+        else:
+            state = model.sample(**inputs, **sample_kwargs, return_state=True)
+            num_images = len(data_samples) * args.grid_size ** 2
+            decoder.submit(state['tokens'][:num_images].view(num_images, m, n, -1),
+                           partial(save, data_samples=data_samples))
+
+    if decoder is not None:
+        decoder.close()
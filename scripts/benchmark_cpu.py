@@ -0,0 +1,113 @@
+import copy
+import time
+import torch
+import numpy as np
+import random
+import argparse
+import os
+from mmengine.config import Config
+from src.builder import BUILDER
+from src.models.cpu_backend import set_cpu_threads, cpu_model_config, quantize_dynamic_int8
+from xtuner.model.utils import guess_load_checkpoint
+
+
+def set_seed(seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='CPU latency of text-to-image and image-to-text, for a range of thread '
+                    'counts, with and without dynamic int8 quantization.')
+    parser.add_argument('--config', help='config file path.', default='configs/models/qwen2_5_0_5b_kl16_mar_b.py')
+    parser.add_argument("--checkpoint", type=str, default='checkpoints/harmon_0.5b.pth')
+    parser.add_argument("--prompt", type=str, default='a white dog on the left and a black cat.')
+    parser.add_argument("--cfg_prompt", type=str, default='Generate an image.')
+    parser.add_argument("--cfg", type=float, default=3.0)
+    parser.add_argument('--num_iter', type=int, default=64)
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--diffusion_sampler', type=str, default='ddpm', choices=['ddpm', 'ddim', 'dpm_solver'])
+    parser.add_argument('--diffusion_steps', type=int, default=None)
+    parser.add_argument('--max_new_tokens', type=int, default=64, help='caption length for image-to-text')
+    parser.add_argument('--tasks', type=str, nargs='+', default=['t2i', 'i2t'], choices=['t2i', 'i2t'])
+    parser.add_argument('--num_threads', type=int, nargs='+', default=[os.cpu_count()])
+    parser.add_argument('--num_interop_threads', type=int, default=None)
+    parser.add_argument('--quantize', type=str, nargs='+', default=['none', 'int8'], choices=['none', 'int8'])
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    set_cpu_threads(num_interop_threads=args.num_interop_threads)
+    config = Config.fromfile(args.config)
+    config.model = cpu_model_config(config.model)
+    model = BUILDER.build(config.model).eval()
+    model = model.to(model.dtype)
+    if os.path.isdir(args.checkpoint):
+        checkpoint = guess_load_checkpoint(args.checkpoint)
+    else:
+        checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    info = model.load_state_dict(checkpoint, strict=False)
+
+    models = dict()
+    for mode in args.quantize:
+        models[mode] = quantize_dynamic_int8(copy.deepcopy(model)) if mode == 'int8' else model
+
+    m = n = args.image_size // 16
+
+    @torch.no_grad()
+    def text2image(model):
+        class_info = model.prepare_text_conditions(f"Generate an image: {args.prompt}", args.cfg_prompt)
+        input_ids, attention_mask = class_info['input_ids'], class_info['attention_mask']
+        if args.cfg == 1.0:
+            input_ids, attention_mask = input_ids[:1], attention_mask[:1]
+        return model.sample(input_ids=input_ids, attention_mask=attention_mask,
+                            num_iter=args.num_iter, cfg=args.cfg, image_shape=(m, n),
+                            diffusion_sampler=args.diffusion_sampler, diffusion_steps=args.diffusion_steps)
+
+    @torch.no_grad()
+    def image2text(model, image):
+        # the visual tokens take the place of the image placeholders, as in image2text.py
+        _, z_enc = model.extract_visual_feature(model.encode(image))
+        prompt = model.prompt_template['INSTRUCTION'].format(input="<image>\nDescribe the image in detail.")
+        prefix, suffix = prompt.split('<image>')
+        prefix_ids = model.tokenizer.encode(prefix, add_special_tokens=True, return_tensors='pt')
+        suffix_ids = model.tokenizer.encode(suffix, add_special_tokens=False, return_tensors='pt')
+        embed_tokens = model.llm.get_input_embeddings()
+        inputs_embeds = torch.cat([embed_tokens(prefix_ids), z_enc, embed_tokens(suffix_ids)], dim=1)
+        output = model.llm.generate(inputs_embeds=inputs_embeds,
+                                    use_cache=True,
+                                    do_sample=False,
+                                    min_new_tokens=args.max_new_tokens,
+                                    max_new_tokens=args.max_new_tokens,
+                                    eos_token_id=model.tokenizer.eos_token_id,
+                                    pad_token_id=model.tokenizer.eos_token_id)
+        return output
+
+    set_seed(args.seed)
+    image = torch.rand(1, 3, args.image_size, args.image_size) * 2 - 1
+
+    results = []
+    for mode, model_ in models.items():
+        for num_threads in args.num_threads:
+            torch.set_num_threads(num_threads)
+            for task in args.tasks:
+                run = text2image if task == 't2i' else (lambda model: image2text(model, image))
+                # warm up
+                set_seed(args.seed)
+                run(model_)
+                latencies = []
+                for _ in range(args.repeats):
+                    set_seed(args.seed)
+                    start = time.time()
+                    run(model_)
+                    latencies.append(time.time() - start)
+                results.append((mode, num_threads, task, float(np.mean(latencies))))
+                print(f'{mode} / {num_threads} threads / {task}: {results[-1][-1]:.3f}s', flush=True)
+
+    print(f"{'quantize':<10}{'threads':>8}{'task':>6}{'latency (s)':>14}{'speed-up':>10}")
+    base_latency = {task: latency for mode, num_threads, task, latency in results
+                    if (mode, num_threads) == (args.quantize[0], args.num_threads[0])}
+    for mode, num_threads, task, latency in results:
+        print(f"{mode:<10}{num_threads:>8}{task:>6}{latency:>14.3f}{base_latency[task] / latency:>10.2f}")
@@ -0,0 +1,111 @@
+import time
+import torch
+import numpy as np
+import random
+import argparse
+import os
+from PIL import Image
+from einops import rearrange
+from mmengine.config import Config
+from src.builder import BUILDER
+from xtuner.model.utils import guess_load_checkpoint
+
+
+def set_seed(seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed_all(seed)
+
+
+def psnr(x, y):
+    # images in [-1, 1]
+    mse = ((x.float() - y.float()) ** 2).mean(dim=(1, 2, 3)).clamp(min=1e-10)
+    return (10 * torch.log10(4.0 / mse)).mean().item()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Speed/quality trade-off of reusing LLM features across MAR steps. '
+                    'Every setting is compared against running the LLM on every step (k=1).')
+    parser.add_argument('--config', help='config file path.', default='configs/models/qwen2_5_1_5b_kl16_mar_h.py')
+    parser.add_argument("--checkpoint", type=str, default='checkpoints/harmon_1.5b.pth')
+    parser.add_argument("--prompts", type=str, nargs='+',
+                        default=['a white dog on the left and a black cat.',
+                                 'a red bicycle leaning against a brick wall.'])
+    parser.add_argument("--cfg_prompt", type=str, default='Generate an image.')
+    parser.add_argument("--cfg", type=float, default=3.0)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument('--cfg_schedule', type=str, default='constant')
+    parser.add_argument('--num_iter', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--intervals', type=int, nargs='+', default=[2, 3, 4, 8])
+    parser.add_argument('--thresholds', type=float, nargs='*', default=[],
+                        help='refresh once this fraction of tokens became visible (interval disabled)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='folder to dump the generated images')
+    args = parser.parse_args()
+
+    config = Config.fromfile(args.config)
+    model = BUILDER.build(config.model).eval().cuda()
+    model = model.to(model.dtype)
+    if os.path.isdir(args.checkpoint):
+        checkpoint = guess_load_checkpoint(args.checkpoint)
+    else:
+        checkpoint = torch.load(args.checkpoint)
+    info = model.load_state_dict(checkpoint, strict=False)
+
+    m = n = args.image_size // 16
+    settings = [dict(llm_refresh_interval=1)]
+    settings += [dict(llm_refresh_interval=k) for k in args.intervals]
+    settings += [dict(llm_refresh_interval=args.num_iter, llm_refresh_threshold=t) for t in args.thresholds]
+
+    def generate(prompt, **kwargs):
+        class_info = model.prepare_text_conditions(f"Generate an image: {prompt}", args.cfg_prompt)
+        input_ids, attention_mask = class_info['input_ids'], class_info['attention_mask']
+        if args.cfg != 1.0:
+            input_ids = torch.cat([input_ids[:1].expand(args.batch_size, -1),
+                                   input_ids[1:].expand(args.batch_size, -1)])
+            attention_mask = torch.cat([attention_mask[:1].expand(args.batch_size, -1),
+                                        attention_mask[1:].expand(args.batch_size, -1)])
+        else:
+            input_ids = input_ids[:1].expand(args.batch_size, -1)
+            attention_mask = attention_mask[:1].expand(args.batch_size, -1)
+        set_seed(args.seed)
+        torch.cuda.synchronize()
+        start = time.time()
+        samples = model.sample(input_ids=input_ids, attention_mask=attention_mask,
+                               num_iter=args.num_iter, cfg=args.cfg, cfg_schedule=args.cfg_schedule,
+                               temperature=args.temperature, image_shape=(m, n), **kwargs)
+        torch.cuda.synchronize()
+        return samples, time.time() - start
+
+    # warm up kernels and allocator before timing
+    generate(args.prompts[0])
+
+    results = []
+    references = {}
+    for setting in settings:
+        latency, scores = 0.0, []
+        for prompt_idx, prompt in enumerate(args.prompts):
+            samples, elapsed = generate(prompt, **setting)
+            latency += elapsed
+            if setting is settings[0]:
+                references[prompt_idx] = samples
+            else:
+                scores.append(psnr(samples, references[prompt_idx]))
+            if args.output is not None:
+                os.makedirs(args.output, exist_ok=True)
+                name = '_'.join(f'{k.replace("llm_refresh_", "")}{v}' for k, v in setting.items())
+                images = torch.clamp(127.5 * samples + 128.0, 0, 255).to("cpu", dtype=torch.uint8)
+                images = rearrange(images, 'b c h w -> h (b w) c').numpy()
+                Image.fromarray(images).save(os.path.join(args.output, f'{prompt_idx:03d}_{name}.jpg'))
+        results.append((setting, latency / len(args.prompts), np.mean(scores) if scores else float('inf')))
+
+    base_latency = results[0][1]
+    print(f"{'setting':<40}{'latency (s)':>14}{'speed-up':>10}{'PSNR vs k=1':>14}")
+    for setting, latency, score in results:
+        name = ', '.join(f'{k}={v}' for k, v in setting.items())
+        print(f"{name:<40}{latency:>14.3f}{base_latency / latency:>10.2f}{score:>14.2f}")
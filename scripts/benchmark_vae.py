@@ -0,0 +1,109 @@
+import argparse
+import contextlib
+import time
+
+import torch
+from mmengine.config import Config
+
+from src.builder import BUILDER
+from src.models.mar.vae import AttnBlock
+
+
+def reference_attn_forward(self, x):
+    # the original AttnBlock.forward, which materializes the hw x hw attention matrix
+    h_ = x
+    h_ = self.norm(h_)
+    q = self.q(h_)
+    k = self.k(h_)
+    v = self.v(h_)
+
+    b, c, h, w = q.shape
+    q = q.reshape(b, c, h * w)
+    q = q.permute(0, 2, 1)
+    k = k.reshape(b, c, h * w)
+    w_ = torch.bmm(q, k)
+    w_ = w_ * (int(c) ** (-0.5))
+    w_ = torch.nn.functional.softmax(w_, dim=2)
+
+    v = v.reshape(b, c, h * w)
+    w_ = w_.permute(0, 2, 1)
+    h_ = torch.bmm(v, w_)
+    h_ = h_.reshape(b, c, h, w)
+
+    h_ = self.proj_out(h_)
+
+    return x + h_
+
+
+@contextlib.contextmanager
+def reference_attention():
+    forward = AttnBlock.forward
+    AttnBlock.forward = reference_attn_forward
+    try:
+        yield
+    finally:
+        AttnBlock.forward = forward
+
+
+def set_mode(vae, channels_last, autocast_dtype):
+    vae.channels_last = channels_last
+    vae.autocast_dtype = autocast_dtype
+    vae.to(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+
+
+@torch.no_grad()
+def run(fn, x, repeats):
+    fn(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(repeats):
+        out = fn(x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if x.is_cuda else float('nan')
+    return out.float(), (time.time() - start) / repeats, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Parity and speed/memory of the KL-VAE with fused attention, channels_last and '
+                    'bf16 autocast, against the original attention in float32.')
+    parser.add_argument('--config', help='config file path.', default='configs/models/qwen2_5_0_5b_kl16_mar_b.py')
+    parser.add_argument('--image_size', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    config = Config.fromfile(args.config)
+    vae = BUILDER.build(config.model.vae).eval().to(args.device)
+    stride = 2 ** (len(vae.decoder.up) - 1)
+
+    # the fused attention alone, on random features
+    block = vae.decoder.mid.attn_1
+    x = torch.randn(2, block.in_channels, 16, 16, device=args.device)
+    with torch.no_grad():
+        attn_error = (block(x) - reference_attn_forward(block, x)).abs().max().item()
+    print(f"AttnBlock fused vs reference, max abs error: {attn_error:.2e}")
+
+    modes = dict(fused=(False, None), channels_last=(True, None), bf16=(True, torch.bfloat16))
+    print(f"{'size':>6}{'path':>10}{'mode':>15}{'max err':>10}{'time (ms)':>11}{'peak (MB)':>11}")
+    for image_size in args.image_size:
+        images = torch.rand(args.batch_size, 3, image_size, image_size, device=args.device) * 2 - 1
+        latents = torch.randn(args.batch_size, vae.embed_dim, image_size // stride, image_size // stride,
+                              device=args.device)
+        for path, fn, x in [('encode', lambda x: vae.encode(x).mode(), images), ('decode', vae.decode, latents)]:
+            set_mode(vae, False, None)
+            with reference_attention():
+                reference, latency, peak = run(fn, x, args.repeats)
+            print(f"{image_size:>6}{path:>10}{'reference':>15}{0:>10.2e}{latency * 1e3:>11.1f}{peak:>11.0f}")
+            for mode, (channels_last, autocast_dtype) in modes.items():
+                set_mode(vae, channels_last, autocast_dtype)
+                out, latency, peak = run(fn, x, args.repeats)
+                error = (out - reference).abs().max().item()
+                print(f"{image_size:>6}{path:>10}{mode:>15}{error:>10.2e}{latency * 1e3:>11.1f}{peak:>11.0f}")
+        set_mode(vae, False, None)
@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from accelerate import Accelerator
+from mmengine.config import Config
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+from src.builder import BUILDER
+
+
+def collate(instances):
+    return dict(pixel_values=torch.stack([example['pixel_values'] for example in instances]),
+                captions=[example['caption'] for example in instances])
+
+
+class ShardWriter:
+    """Fills `latents_{shard}.npy` ([n, views, c, h, w], memory-mappable) and
+    `captions_{shard}.jsonl` of one shard, and moves them in place on close,
+    so that an interrupted run leaves no partial shard behind."""
+
+    def __init__(self, output_dir, shard, shard_size, dtype):
+        self.output_dir = output_dir
+        self.shard = shard
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.latents = None
+        self.captions = []
+
+    def path(self, name, tmp=False):
+        return os.path.join(self.output_dir, f'{name}_{self.shard:05d}' + ('.tmp' if tmp else ''))
+
+    def write(self, latents, caption):
+        if self.latents is None:
+            self.latents = np.lib.format.open_memmap(self.path('latents', tmp=True), mode='w+', dtype=self.dtype,
+                                                     shape=(self.shard_size, *latents.shape))
+        self.latents[len(self.captions)] = latents
+        self.captions.append(caption)
+
+    def close(self):
+        assert len(self.captions) == self.shard_size
+        self.latents.flush()
+        del self.latents
+        with open(self.path('captions', tmp=True), 'w') as f:
+            f.writelines(json.dumps(caption) + '\n' for caption in self.captions)
+        os.replace(self.path('latents', tmp=True), self.path('latents') + '.npy')
+        os.replace(self.path('captions', tmp=True), self.path('captions') + '.jsonl')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Encode the images of a text-to-image dataset once with the frozen VAE into a sharded, '
+                    'memory-mapped latent store for CachedLatentText2ImageDataset.')
+    parser.add_argument('config', help='dataset config file path, e.g. configs/datasets/qwen2_5_0_5b/text2image.py')
+    parser.add_argument('--model_config', default='configs/models/qwen2_5_0_5b_kl16_mar_b.py',
+                        help='model config file path, only its VAE is built')
+    parser.add_argument('--output_dir', required=True, type=str)
+    parser.add_argument('--shard_size', default=10000, type=int)
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--flip', action='store_true', help='also store the latent of the horizontally flipped image')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+    args = parser.parse_args()
+
+    accelerator = Accelerator()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    config = Config.fromfile(args.config)
+    dataset = BUILDER.build(config.dataset)
+    # keep the raw caption: it is tokenized, and dropped for cfg, when training on the cache
+    dataset._process_text = lambda text: dict(caption=text)
+    model_config = Config.fromfile(args.model_config)
+    vae = BUILDER.build(model_config.model.vae).eval().to(accelerator.device)
+    vae.requires_grad_(False)
+
+    # shards are assigned round-robin to the processes; finished shards are skipped, so the run can be resumed
+    shard_sizes = [min(args.shard_size, len(dataset) - start) for start in range(0, len(dataset), args.shard_size)]
+    shards = [shard for shard in range(accelerator.process_index, len(shard_sizes), accelerator.num_processes)
+              if not os.path.exists(os.path.join(args.output_dir, f'captions_{shard:05d}.jsonl'))]
+    indices = [shard * args.shard_size + i for shard in shards for i in range(shard_sizes[shard])]
+    dataloader = DataLoader(Subset(dataset, indices), batch_size=args.batch_size, num_workers=args.num_workers,
+                            collate_fn=collate, pin_memory=True)
+
+    writer = None
+    position = 0
+    for batch in tqdm(dataloader, disable=not accelerator.is_main_process):
+        x = batch['pixel_values'].to(accelerator.device)
+        with torch.no_grad():
+            views = [vae.encode(x).mode()]
+            if args.flip:
+                views.append(vae.encode(x.flip(-1)).mode())
+        latents = torch.stack(views, dim=1).cpu().numpy()     # b views c h w
+
+        for latent, caption in zip(latents, batch['captions']):
+            shard = indices[position] // args.shard_size
+            if writer is None or writer.shard != shard:
+                if writer is not None:
+                    writer.close()
+                writer = ShardWriter(args.output_dir, shard, shard_sizes[shard], args.dtype)
+            writer.write(latent, caption)
+            position += 1
+    if writer is not None:
+        writer.close()
+
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process:
+        latent_shape = np.load(os.path.join(args.output_dir, 'latents_00000.npy'), mmap_mode='r').shape[1:]
+        meta = dict(num_samples=len(dataset), shard_sizes=shard_sizes, latent_shape=list(latent_shape),
+                    dtype=args.dtype, flip=args.flip, vae=model_config.model.vae.get('ckpt_path'))
+        with open(os.path.join(args.output_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        print(f"Cached {len(dataset)} latents in {len(shard_sizes)} shards to {args.output_dir}", flush=True)
@@ -0,0 +1,101 @@
+import torch
+from src.builder import BUILDER
+from src.models.draft_refine import sample_draft_then_refine
+from PIL import Image
+from mmengine.config import Config
+import argparse
+from einops import rearrange
+import numpy as np
+import random
+from xtuner.model.utils import guess_load_checkpoint
+import os
+
+
+def build_model(config_file, checkpoint_file, device):
+    config = Config.fromfile(config_file)
+    model = BUILDER.build(config.model).eval().to(device)
+    model = model.to(model.dtype)
+    if os.path.isdir(checkpoint_file):
+        checkpoint = guess_load_checkpoint(checkpoint_file)
+    else:
+        checkpoint = torch.load(checkpoint_file)
+    info = model.load_state_dict(checkpoint, strict=False)
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Text-to-image with a small draft model for the first MAR steps and a large '
+                    'model for the remaining ones.')
+    parser.add_argument('--draft_config', default='configs/models/qwen2_5_0_5b_kl16_mar_b.py')
+    parser.add_argument("--draft_checkpoint", type=str, default='checkpoints/harmon_0.5b.pth')
+    parser.add_argument('--config', default='configs/models/qwen2_5_1_5b_kl16_mar_h.py')
+    parser.add_argument("--checkpoint", type=str, default='checkpoints/harmon_1.5b.pth')
+    parser.add_argument('--switch_step', type=int, default=16,
+                        help='first MAR step run by the large model')
+    parser.add_argument("--prompt", type=str, default='a white dog on the left and a black cat.')
+    parser.add_argument("--cfg_prompt", type=str, default='Generate an image.')
+    parser.add_argument("--cfg", type=float, default=3.0)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument('--cfg_schedule', type=str, default='constant')
+    parser.add_argument('--num_iter', type=int, default=64)
+    parser.add_argument('--grid_size', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducibility')
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--diffusion_sampler', type=str, default='ddpm', choices=['ddpm', 'ddim', 'dpm_solver'])
+    parser.add_argument('--diffusion_steps', type=int, default=None,
+                        help='diffusion steps per MAR step (defaults to the num_sampling_steps of the model)')
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--output', type=str, default='output.jpg')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+        np.random.seed(args.seed)
+        random.seed(args.seed)
+
+    draft_model = build_model(args.draft_config, args.draft_checkpoint, args.device)
+    model = build_model(args.config, args.checkpoint, args.device)
+
+    args.prompt = f"Generate an image: {args.prompt}"
+    print(args.prompt, flush=True)
+    # the Qwen2.5 models share the tokenizer, the prompts are tokenized once
+    class_info = model.prepare_text_conditions(args.prompt, args.cfg_prompt)
+
+    input_ids = class_info['input_ids']
+    attention_mask = class_info['attention_mask']
+
+    assert len(input_ids) == 2    # the last one is unconditional prompt
+    if args.cfg == 1.0:
+        input_ids = input_ids[:1]
+        attention_mask = attention_mask[:1]
+
+    # repeat
+    bsz = args.grid_size ** 2
+    if args.cfg != 1.0:
+        input_ids = torch.cat([
+            input_ids[:1].expand(bsz, -1),
+            input_ids[1:].expand(bsz, -1),
+        ])
+        attention_mask = torch.cat([
+            attention_mask[:1].expand(bsz, -1),
+            attention_mask[1:].expand(bsz, -1),
+        ])
+    else:
+        input_ids = input_ids.expand(bsz, -1)
+        attention_mask = attention_mask.expand(bsz, -1)
+
+    m = n = args.image_size // 16
+    generator = None if args.seed is None else [args.seed + i for i in range(bsz)]
+
+    samples = sample_draft_then_refine(draft_model, model, input_ids=input_ids, attention_mask=attention_mask,
+                                       switch_step=args.switch_step, num_iter=args.num_iter,
+                                       generator=generator, cfg=args.cfg, cfg_schedule=args.cfg_schedule,
+                                       temperature=args.temperature, progress=True, image_shape=(m, n),
+                                       diffusion_sampler=args.diffusion_sampler,
+                                       diffusion_steps=args.diffusion_steps)
+    samples = rearrange(samples, '(m n) c h w -> (m h) (n w) c', m=args.grid_size, n=args.grid_size)
+    samples = torch.clamp(
+        127.5 * samples + 128.0, 0, 255).to("cpu", dtype=torch.uint8).numpy()
+
+    Image.fromarray(samples).save(args.output)
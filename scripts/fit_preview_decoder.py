@@ -0,0 +1,148 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from mmengine.config import Config
+from tqdm import tqdm
+
+from src.builder import BUILDER
+from src.models.mar.preview_decoder import LatentPreviewDecoder
+
+
+def load_image(path, image_size):
+    image = Image.open(path).convert('RGB')
+    scale = image_size / min(image.size)
+    image = image.resize((max(image_size, round(image.width * scale)),
+                          max(image_size, round(image.height * scale))), Image.BICUBIC)
+    left, top = (image.width - image_size) // 2, (image.height - image_size) // 2
+    image = image.crop((left, top, left + image_size, top + image_size))
+    image = torch.from_numpy(np.asarray(image)).permute(2, 0, 1).float()
+    return image / 127.5 - 1
+
+
+@torch.no_grad()
+def encode_decode(vae, paths, image_size, batch_size, device):
+    """kl16 latents of the images and their full `AutoencoderKL.decode`, the
+    target of the preview decoder."""
+    latents, targets = [], []
+    for i in tqdm(range(0, len(paths), batch_size), desc='encoding'):
+        x = torch.stack([load_image(path, image_size) for path in paths[i:i + batch_size]]).to(device)
+        z = vae.encode(x).mode()
+        latents.append(z.cpu())
+        targets.append(vae.decode(z).clamp(-1, 1).half().cpu())
+    return torch.cat(latents), torch.cat(targets)
+
+
+def fit_linear(decoder, latents, targets, batch_size):
+    # least squares on the normal equations, accumulated over batches in float64
+    c = decoder.embed_dim
+    xtx = torch.zeros(c + 1, c + 1, dtype=torch.float64)
+    xty = torch.zeros(c + 1, 3 * decoder.stride ** 2, dtype=torch.float64)
+    for i in range(0, len(latents), batch_size):
+        z = latents[i:i + batch_size].double()
+        y = F.pixel_unshuffle(targets[i:i + batch_size].double(), decoder.stride)
+        z = torch.cat([z, torch.ones_like(z[:, :1])], dim=1).permute(0, 2, 3, 1).flatten(0, 2)
+        y = y.permute(0, 2, 3, 1).flatten(0, 2)
+        xtx += z.t() @ z
+        xty += z.t() @ y
+    solution = torch.linalg.solve(xtx + 1e-6 * torch.eye(c + 1, dtype=torch.float64), xty)
+    decoder.set_linear(solution[:c].float(), solution[c].float())
+
+
+def fit_conv(decoder, latents, targets, batch_size, num_steps, lr, device):
+    optimizer = torch.optim.AdamW(decoder.parameters(), lr=lr)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, num_steps)
+    decoder.train()
+    for step in tqdm(range(num_steps), desc='fitting'):
+        idx = torch.randint(len(latents), (batch_size,))
+        loss = F.mse_loss(decoder(latents[idx].to(device)), targets[idx].to(device).float())
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        scheduler.step()
+    decoder.eval()
+
+
+@torch.no_grad()
+def psnr(decode_fn, latents, targets, batch_size, device):
+    mse = []
+    for i in range(0, len(latents), batch_size):
+        x = decode_fn(latents[i:i + batch_size].to(device)).clamp(-1, 1).float()
+        mse.append(((x - targets[i:i + batch_size].to(device).float()) / 2).pow(2).flatten(1).mean(1))
+    return float((-10 * torch.log10(torch.cat(mse))).mean())
+
+
+@torch.no_grad()
+def latency(decode_fn, z, repeats=10):
+    decode_fn(z)
+    if z.is_cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        decode_fn(z)
+    if z.is_cuda:
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Fit a LatentPreviewDecoder against the kl16 VAE decoder and report its fidelity '
+                    'and speed.')
+    parser.add_argument('--config', help='config file path.', default='configs/models/qwen2_5_0_5b_kl16_mar_b.py')
+    parser.add_argument('--image_dir', type=str, required=True, help='folder of calibration images')
+    parser.add_argument('--num_images', type=int, default=2000)
+    parser.add_argument('--num_val', type=int, default=200, help='held-out images for the report')
+    parser.add_argument('--image_size', type=int, default=256)
+    parser.add_argument('--hidden_channels', type=int, default=0,
+                        help='0 fits a linear decoder in closed form, otherwise a tiny conv decoder')
+    parser.add_argument('--num_steps', type=int, default=5000, help='optimizer steps (conv decoder only)')
+    parser.add_argument('--lr', type=float, default=1e-3)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default='checkpoints/kl16_preview_decoder.pth')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    config = Config.fromfile(args.config)
+    # only the VAE is needed
+    vae = BUILDER.build(config.model.vae).eval().to(args.device)
+    vae.requires_grad_(False)
+
+    paths = sorted(path for ext in ('jpg', 'jpeg', 'png', 'webp')
+                   for path in glob.glob(os.path.join(args.image_dir, '**', f'*.{ext}'), recursive=True))
+    paths = [paths[i] for i in np.random.RandomState(args.seed).permutation(len(paths))[:args.num_images]]
+    assert len(paths) > args.num_val, f'found {len(paths)} images in {args.image_dir}'
+    latents, targets = encode_decode(vae, paths, args.image_size, args.batch_size, args.device)
+    train_latents, train_targets = latents[args.num_val:], targets[args.num_val:]
+    val_latents, val_targets = latents[:args.num_val], targets[:args.num_val]
+
+    decoder = LatentPreviewDecoder(embed_dim=vae.embed_dim, stride=args.image_size // latents.shape[-1],
+                                   hidden_channels=args.hidden_channels)
+    if decoder.is_linear:
+        fit_linear(decoder, train_latents, train_targets, args.batch_size)
+        decoder = decoder.to(args.device)
+    else:
+        decoder = decoder.to(args.device)
+        fit_conv(decoder, train_latents, train_targets, args.batch_size, args.num_steps, args.lr, args.device)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    torch.save(dict(model=decoder.state_dict(), hidden_channels=args.hidden_channels), args.output)
+
+    # fidelity against the full VAE decode on held-out images, and speed of both decoders
+    z = val_latents[:args.batch_size].to(args.device)
+    vae_latency = latency(vae.decode, z)
+    preview_latency = latency(decoder, z)
+    print(f"preview decoder saved to {args.output}")
+    print(f"PSNR to the VAE decode: {psnr(decoder, val_latents, val_targets, args.batch_size, args.device):.2f} dB "
+          f"({args.num_val} held-out images)")
+    print(f"batch of {len(z)}: VAE decode {vae_latency * 1e3:.1f} ms, preview {preview_latency * 1e3:.1f} ms "
+          f"({vae_latency / preview_latency:.1f}x faster)")
+    print(f"enable it with model.preview_decoder=dict(type=LatentPreviewDecoder, embed_dim={vae.embed_dim}, "
+          f"stride={decoder.stride}, hidden_channels={args.hidden_channels}, ckpt_path='{args.output}')")
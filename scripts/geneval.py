@@ -18,6 +18,9 @@ import random
 import numpy as np
 import torch
 from src.builder import BUILDER
+from src.models.cache_utils import PrefixKVCache
+from src.models.async_decode import AsyncDecoder
+from functools import partial
 from PIL import Image
 from mmengine.config import Config
 import argparse
@@ -38,6 +41,19 @@ def set_seed(seed=0):
         torch.backends.cudnn.benchmark = False
 
 
+def save_samples(samples, sample_path):
+    # 后处理和保存每张图片
+    for i, sample in enumerate(samples):
+        # 将图像数据转换为正确格式
+        sample = torch.clamp(127.5 * sample + 128.0, 0, 255).to("cpu", dtype=torch.uint8).numpy()
+        sample = sample.transpose(1, 2, 0)  # 从[C,H,W]转换为[H,W,C]
+
+        # 保存单张图片
+        out_path = os.path.join(sample_path, f"{i:05}.png")
+        Image.fromarray(sample).save(out_path)
+        print(f"图像保存到: {out_path}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', help='config file path.', default='configs/models/qwen2_5_1_5b_kl16_mar_h.py')
@@ -56,6 +72,17 @@ if __name__ == "__main__":
     parser.add_argument('--l', type=int, default=0, help='Start index for processing')
     parser.add_argument('--r', type=int, default=None, help='End index for processing')
     parser.add_argument('--use_template', action='store_true', help='Use prompt template')
+    parser.add_argument('--prefix_cache_mb', type=float, default=0,
+                        help='memory budget of the cross-prompt KV prefix cache (0 disables it)')
+    parser.add_argument('--prefix_cache_dir', type=str, default=None,
+                        help='spill prefix cache entries evicted from memory to this folder')
+    parser.add_argument('--diffusion_sampler', type=str, default='ddpm', choices=['ddpm', 'ddim', 'dpm_solver'])
+    parser.add_argument('--diffusion_steps', type=int, default=None,
+                        help='diffusion steps per MAR step (defaults to the num_sampling_steps of the model)')
+    parser.add_argument('--decode_batch_size', type=int, default=None,
+                        help='VAE-decode in micro-batches of this many images')
+    parser.add_argument('--async_decode', action='store_true',
+                        help='decode and save on a worker thread, overlapped with the next prompt')
     parser.add_argument('--exp', type=str, default='exp4')
     parser.add_argument('--step', type=int, default=0)
     parser.add_argument('--remove_prefix', action='store_true', help='Remove prefix from prompts')
@@ -85,6 +112,10 @@ if __name__ == "__main__":
         else:
             checkpoint = torch.load(args.checkpoint, weights_only=False)
     info = model.load_state_dict(checkpoint, strict=False)
+    decoder = AsyncDecoder(model, batch_size=args.decode_batch_size) if args.async_decode else None
+    prefix_cache = None
+    if args.prefix_cache_mb > 0:
+        prefix_cache = PrefixKVCache(max_bytes=int(args.prefix_cache_mb * 2 ** 20), disk_dir=args.prefix_cache_dir)
     # 加载评估数据
     try:
         with open(args.validation_prompts_file) as fp:
@@ -164,27 +195,29 @@ if __name__ == "__main__":
         
         # 生成样本
         print(f"正在一次性生成 {batch_size} 张图片...")
+        sample_kwargs = dict(input_ids=input_ids,
+                             attention_mask=attention_mask,
+                             num_iter=args.generation_timesteps,
+                             cfg=args.guidance_scale,
+                             cfg_schedule=args.cfg_schedule,
+                             temperature=args.temperature,
+                             progress=True,
+                             image_shape=(img_h, img_w),
+                             prefix_cache=prefix_cache,
+                             diffusion_sampler=args.diffusion_sampler,
+                             diffusion_steps=args.diffusion_steps,
+                             # one random stream per image, independent of the batch size
+                             generator=[args.seed + i for i in range(batch_size)])
         with torch.no_grad():
-            samples = model.sample(input_ids=input_ids, 
-                                  attention_mask=attention_mask,
-                                  num_iter=args.generation_timesteps, 
-                                  cfg=args.guidance_scale, 
-                                  cfg_schedule=args.cfg_schedule,
-                                  temperature=args.temperature, 
-                                  progress=True, 
-                                  image_shape=(img_h, img_w))
-        # samples = rearrange(samples, '(m n) c h w -> (m h) (n w) c', m=1, n=1)
-        # 后处理和保存每张图片
-        for i in range(batch_size):
-            sample = samples[i]
-            # 将图像数据转换为正确格式
-            sample = torch.clamp(127.5 * sample + 128.0, 0, 255).to("cpu", dtype=torch.uint8).numpy()
-            # import pdb; pdb.set_trace()
-            sample = sample.transpose(1, 2, 0)  # 从[C,H,W]转换为[H,W,C]
-            
-            # 保存单张图片
-            out_path = os.path.join(sample_path, f"{i:05}.png")
-            Image.fromarray(sample).save(out_path)
-            print(f"图像保存到: {out_path}")
+            if decoder is None:
+                samples = model.sample(**sample_kwargs, decode_batch_size=args.decode_batch_size)
+                save_samples(samples, sample_path)
+            else:
+                # decode and save while the next prompt is sampled
+                state = model.sample(**sample_kwargs, return_state=True)
+                decoder.submit(state['tokens'][:batch_size].view(batch_size, img_h, img_w, -1),
+                               partial(save_samples, sample_path=sample_path))
     
+    if decoder is not None:
+        decoder.close()
     print("Done!")
\ No newline at end of file
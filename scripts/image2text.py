@@ -4,6 +4,7 @@ import torch
 from PIL import Image
 from mmengine.config import Config
 from src.builder import BUILDER
+from src.models.cpu_backend import set_cpu_threads, cpu_model_config, quantize_dynamic_int8
 from einops import rearrange
 import argparse
 from xtuner.model.utils import guess_load_checkpoint
@@ -31,10 +32,23 @@ if __name__ == '__main__':
     parser.add_argument("--prompt", type=str, default="Describe the image in detail.")
     parser.add_argument("--output", type=str, default="output.txt",
                         help="Output file to save the generated text.")
+    parser.add_argument('--vae_tile_size', type=int, default=None,
+                        help='run the VAE in tiles of this many pixels (a multiple of 16) for large images '
+                             '(default: vae_tile_size of the model config)')
+    parser.add_argument('--vae_tile_overlap', type=int, default=None,
+                        help='overlap of the VAE tiles in pixels (default: vae_tile_overlap of the model config)')
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads on CPU')
+    parser.add_argument('--num_interop_threads', type=int, default=None, help='inter-op threads on CPU')
+    parser.add_argument('--quantize', action='store_true',
+                        help='dynamic int8 quantization of the LLM, MAR and diffusion head (CPU only)')
     args = parser.parse_args()
 
     config = Config.fromfile(args.config)
-    model = BUILDER.build(config.model).eval().cuda()
+    if args.device == 'cpu':
+        set_cpu_threads(args.num_threads, args.num_interop_threads)
+        config.model = cpu_model_config(config.model)
+    model = BUILDER.build(config.model).eval().to(args.device)
     model = model.to(model.dtype)
     if args.checkpoint is not None:
         print(f"Load checkpoint: {args.checkpoint}", flush=True)
@@ -42,6 +56,13 @@ if __name__ == '__main__':
         checkpoint = guess_load_checkpoint(args.checkpoint)
         info = model.load_state_dict(checkpoint, strict=False)
 
+    if args.quantize:
+        quantize_dynamic_int8(model)
+    if args.vae_tile_size is not None:
+        model.vae_tile_size = args.vae_tile_size
+    if args.vae_tile_overlap is not None:
+        model.vae_tile_overlap = args.vae_tile_overlap
+
     special_tokens_dict = {'additional_special_tokens': ["<image>", ]}
     num_added_toks = model.tokenizer.add_special_tokens(special_tokens_dict)
     assert num_added_toks == 1
@@ -63,7 +84,7 @@ if __name__ == '__main__':
     image_length = (args.image_size // 16) ** 2 + 64
     prompt = prompt.replace('<image>', '<image>'*image_length)
     input_ids = model.tokenizer.encode(
-        prompt, add_special_tokens=True, return_tensors='pt').cuda()
+        prompt, add_special_tokens=True, return_tensors='pt').to(model.device)
     with torch.no_grad():
         _, z_enc = model.extract_visual_feature(model.encode(image))
     inputs_embeds = z_enc.new_zeros(*input_ids.shape, model.llm.config.hidden_size)
@@ -1,5 +1,6 @@
 import torch
 from src.builder import BUILDER
+from src.models.cpu_backend import set_cpu_threads, cpu_model_config, quantize_dynamic_int8
 from PIL import Image
 from mmengine.config import Config
 import argparse
@@ -9,6 +10,14 @@ import random
 from xtuner.model.utils import guess_load_checkpoint
 import os
 
+def save_grid(samples, path, grid_size):
+    samples = rearrange(samples, '(m n) c h w -> (m h) (n w) c', m=grid_size, n=grid_size)
+    samples = torch.clamp(
+        127.5 * samples + 128.0, 0, 255).to("cpu", dtype=torch.uint8).numpy()
+
+    Image.fromarray(samples).save(path)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     
@@ -24,7 +33,43 @@ if __name__ == "__main__":
     parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducibility')
     parser.add_argument('--image_size', type=int, default=512)
     parser.add_argument('--output', type=str, default='output.jpg')
+    parser.add_argument('--static_cache', action='store_true',
+                        help='Write image tokens into a preallocated KV cache instead of growing it.')
+    parser.add_argument('--static_engine', action='store_true',
+                        help='Use the shape-static sampling engine (Harmon.sample_static).')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the MAR step with torch.compile (static engine only).')
+    parser.add_argument('--bucket_tokens', action='store_true',
+                        help='Pad the tokens sampled per step to a power of two (static engine only).')
+    parser.add_argument('--cfg_interval', type=float, nargs=2, default=None,
+                        help='Only apply CFG within this range of MAR steps (or mask ratios).')
+    parser.add_argument('--cfg_interval_type', type=str, default=None, choices=['step', 'mask_ratio'],
+                        help='unit of --cfg_interval (default: step)')
+    parser.add_argument('--diffusion_sampler', type=str, default='ddpm', choices=['ddpm', 'ddim', 'dpm_solver'])
+    parser.add_argument('--diffusion_steps', type=int, default=None,
+                        help='diffusion steps per MAR step (defaults to the num_sampling_steps of the model)')
+    parser.add_argument('--preview_interval', type=int, default=0,
+                        help='also save a preview of the partial image every k MAR steps (0 disables it)')
+    parser.add_argument('--vae_tile_size', type=int, default=None,
+                        help='run the VAE in tiles of this many pixels (a multiple of 16) for large images '
+                             '(default: vae_tile_size of the model config)')
+    parser.add_argument('--vae_tile_overlap', type=int, default=None,
+                        help='overlap of the VAE tiles in pixels (default: vae_tile_overlap of the model config)')
+    parser.add_argument('--device', type=str, default='cuda')
+    parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads on CPU')
+    parser.add_argument('--num_interop_threads', type=int, default=None, help='inter-op threads on CPU')
+    parser.add_argument('--quantize', action='store_true',
+                        help='dynamic int8 quantization of the LLM, MAR and diffusion head (CPU only)')
     args = parser.parse_args()
+    if args.static_engine:
+        if args.static_cache:
+            parser.error('--static_cache is not supported with --static_engine')
+        if args.preview_interval > 0:
+            parser.error('--preview_interval is not supported with --static_engine')
+        if args.cfg_interval is not None or args.cfg_interval_type is not None:
+            parser.error('--cfg_interval and --cfg_interval_type are not supported with --static_engine')
+    elif args.compile or args.bucket_tokens:
+        parser.error('--compile and --bucket_tokens require --static_engine')
 
     # 设置随机种子以确保结果可重复
     if args.seed is not None:
@@ -37,7 +82,10 @@ if __name__ == "__main__":
         print(f"Random seed set to {args.seed}")
 
     config = Config.fromfile(args.config)
-    model = BUILDER.build(config.model).eval().cuda()
+    if args.device == 'cpu':
+        set_cpu_threads(args.num_threads, args.num_interop_threads)
+        config.model = cpu_model_config(config.model)
+    model = BUILDER.build(config.model).eval().to(args.device)
     model = model.to(model.dtype)
 
     if os.path.isdir(args.checkpoint):
@@ -46,6 +94,12 @@ if __name__ == "__main__":
        checkpoint = torch.load(args.checkpoint)
        
     info = model.load_state_dict(checkpoint, strict=False)
+    if args.quantize:
+        quantize_dynamic_int8(model)
+    if args.vae_tile_size is not None:
+        model.vae_tile_size = args.vae_tile_size
+    if args.vae_tile_overlap is not None:
+        model.vae_tile_overlap = args.vae_tile_overlap
     args.prompt = f"Generate an image: {args.prompt}"
     print(args.prompt, flush=True)
     class_info = model.prepare_text_conditions(args.prompt, args.cfg_prompt)
@@ -75,11 +129,26 @@ if __name__ == "__main__":
 
     m = n = args.image_size // 16
 
-    samples = model.sample(input_ids=input_ids, attention_mask=attention_mask,
-                           num_iter=args.num_iter, cfg=args.cfg, cfg_schedule=args.cfg_schedule,
-                           temperature=args.temperature, progress=True, image_shape=(m, n))
-    samples = rearrange(samples, '(m n) c h w -> (m h) (n w) c', m=args.grid_size, n=args.grid_size)
-    samples = torch.clamp(
-        127.5 * samples + 128.0, 0, 255).to("cpu", dtype=torch.uint8).numpy()
-
-    Image.fromarray(samples).save(args.output)
+    if args.static_engine:
+        samples = model.sample_static(input_ids=input_ids, attention_mask=attention_mask,
+                                      num_iter=args.num_iter, cfg=args.cfg, cfg_schedule=args.cfg_schedule,
+                                      temperature=args.temperature, progress=True, image_shape=(m, n),
+                                      compile=args.compile, bucket_tokens=args.bucket_tokens,
+                                      diffusion_sampler=args.diffusion_sampler,
+                                      diffusion_steps=args.diffusion_steps)
+    else:
+        yield_steps = range(args.preview_interval - 1, args.num_iter, args.preview_interval) \
+            if args.preview_interval > 0 else ()
+        for out in model.sample_progressive(input_ids=input_ids, attention_mask=attention_mask,
+                                            num_iter=args.num_iter, cfg=args.cfg, cfg_schedule=args.cfg_schedule,
+                                            temperature=args.temperature, progress=True, image_shape=(m, n),
+                                            static_cache=args.static_cache, cfg_interval=args.cfg_interval,
+                                            cfg_interval_type=args.cfg_interval_type or 'step',
+                                            diffusion_sampler=args.diffusion_sampler,
+                                            diffusion_steps=args.diffusion_steps,
+                                            yield_steps=yield_steps, preview=True):
+            if not out['final']:
+                save_grid(out['images'], os.path.splitext(args.output)[0] + f"_step{out['step']:03d}.jpg",
+                          args.grid_size)
+        samples = out['images']
+    save_grid(samples, args.output, args.grid_size)
@@ -8,9 +8,12 @@ from dataclasses import dataclass
 
 def collate_func_gen(instances: Sequence[Dict],
                      pad_index: int = DEFAULT_PAD_TOKEN_INDEX):
-    pixel_values, input_ids, input_lengths = [], [], []
+    pixel_values, latents, input_ids, input_lengths = [], [], [], []
     for example in instances:
-        pixel_values.append(example.pop('pixel_values'))
+        if 'latents' in example:
+            latents.append(example.pop('latents'))
+        else:
+            pixel_values.append(example.pop('pixel_values'))
         input_lengths.append(len(example['input_ids']))
         input_ids.append(example.pop('input_ids'))
 
@@ -19,9 +22,13 @@ def collate_func_gen(instances: Sequence[Dict],
     for i in range(len(input_ids)):
         attention_mask[i, :input_lengths[i]] = True
 
-    data_dict = dict(pixel_values=torch.stack(pixel_values),
-                     input_ids=input_ids,
+    data_dict = dict(input_ids=input_ids,
                      attention_mask=attention_mask)
+    if len(latents) > 0:
+        assert len(pixel_values) == 0, 'cannot mix cached latents and images in a batch'
+        data_dict.update(latents=torch.stack(latents))
+    else:
+        data_dict.update(pixel_values=torch.stack(pixel_values))
 
     return {'data': data_dict, 'data_samples': None}
 
@@ -76,3 +83,64 @@ class CollateConcat(object):
         data_dict[key] = self.collate_fns[key](data_samples)['data']
 
         return {'data': data_dict, 'data_samples': None}
+
+
+def packed_position_ids(seq_lengths):
+    """Position ids of sequences of `seq_lengths` concatenated into one row,
+    restarting at 0 for every sequence. With flash_attention_2, transformers
+    derives the sequence boundaries of varlen attention from them."""
+    seq_lengths = torch.as_tensor(seq_lengths)
+    offsets = torch.cumsum(seq_lengths, dim=0) - seq_lengths
+    position_ids = torch.arange(int(seq_lengths.sum())) - offsets.repeat_interleave(seq_lengths)
+    return position_ids[None]
+
+
+def collate_func_gen_packed(instances: Sequence[Dict]):
+    """Padding-free counterpart of `collate_func_gen` for
+    `HarmonDev(use_varlen_attn=True)`: the prompts are concatenated into a
+    single row, delimited by `seq_lengths`, and the model appends every image
+    to its prompt."""
+    pixel_values, latents, input_ids = [], [], []
+    for example in instances:
+        if 'latents' in example:
+            latents.append(example.pop('latents'))
+        else:
+            pixel_values.append(example.pop('pixel_values'))
+        input_ids.append(example.pop('input_ids'))
+
+    data_dict = dict(input_ids=torch.cat(input_ids)[None],
+                     seq_lengths=torch.tensor([len(input_ids_) for input_ids_ in input_ids]))
+    if len(latents) > 0:
+        assert len(pixel_values) == 0, 'cannot mix cached latents and images in a batch'
+        data_dict.update(latents=torch.stack(latents))
+    else:
+        data_dict.update(pixel_values=torch.stack(pixel_values))
+
+    return {'data': data_dict, 'data_samples': None}
+
+
+def collate_func_und_packed(instances):
+    """Padding-free counterpart of `collate_func_und` for
+    `HarmonDev(use_varlen_attn=True)`: the conversations are concatenated into
+    a single row with `position_ids` restarting at every conversation. The
+    first token of every conversation is not a target, so that no token is
+    predicted across a boundary."""
+    input_ids_list, labels_list, pixel_values_list = [], [], []
+
+    for sample in instances:
+        input_ids_list.append(torch.LongTensor(sample['input_ids']))
+        labels = torch.LongTensor(sample['labels'])
+        labels[0] = IGNORE_INDEX
+        labels_list.append(labels)
+
+        if 'pixel_values' in sample:
+            pixel_values_list.append(sample['pixel_values'])
+
+    data_dict = {
+        'input_ids': torch.cat(input_ids_list)[None],
+        'labels': torch.cat(labels_list)[None],
+        'position_ids': packed_position_ids([len(input_ids_) for input_ids_ in input_ids_list]),
+        'pixel_values': torch.stack(pixel_values_list) if len(pixel_values_list) > 0 else None
+    }
+
+    return {'data': data_dict, 'data_samples': None}
@@ -1,11 +1,63 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import itertools
 from typing import Iterator, List, Optional, Sized, Union
+import numpy as np
 import torch
 from mmengine.dist import get_dist_info, sync_random_seed
 from torch.utils.data import Sampler
 
 
+class FeistelPermutation:
+    """A seeded pseudo-random permutation of ``range(size)``, evaluated
+    lazily.
+
+    A balanced Feistel network is a bijection on the integers of
+    ``2 * half_bits`` bits for any round function. It is applied to the
+    smallest such domain covering ``size`` and re-applied to the values that
+    fall outside of ``range(size)`` (cycle walking), which restricts it to a
+    bijection of ``range(size)``. Memory does not grow with ``size``.
+
+    Args:
+        size (int): Size of the permuted range.
+        generator (torch.Generator): Draws the round keys.
+        num_rounds (int): Number of Feistel rounds. Defaults to 4.
+    """
+
+    def __init__(self,
+                 size: int,
+                 generator: torch.Generator,
+                 num_rounds: int = 4) -> None:
+        self.size = size
+        self.half_bits = np.uint64(max((int(size - 1).bit_length() + 1) // 2,
+                                       1))
+        self.mask = np.uint64((1 << int(self.half_bits)) - 1)
+        self.keys = torch.randint(
+            0, 2**62, (num_rounds, ), generator=generator).numpy().astype(
+                np.uint64)
+
+    def _round(self, x: np.ndarray, key: np.uint64) -> np.ndarray:
+        # splitmix64 finalizer, uint64 arithmetic wraps around
+        x = (x ^ key) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return (x ^ (x >> np.uint64(31))) & self.mask
+
+    def _encrypt(self, x: np.ndarray) -> np.ndarray:
+        left, right = x >> self.half_bits, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
+
+    def __call__(self, positions: np.ndarray) -> np.ndarray:
+        """Map an array of positions in ``range(size)`` to their indices."""
+        x = self._encrypt(np.asarray(positions, dtype=np.uint64))
+        outside = x >= self.size
+        while outside.any():
+            x[outside] = self._encrypt(x[outside])
+            outside = x >= self.size
+        return x.astype(np.int64)
+
+
 class FixedBatchMultiSourceSampler(Sampler):
     r"""Multi-Source Infinite Sampler.
 
@@ -19,6 +71,17 @@ class FixedBatchMultiSourceSampler(Sampler):
         shuffle (bool): Whether shuffle the dataset or not. Defaults to True.
         seed (int, optional): Random seed. If None, set a random seed.
             Defaults to None.
+        group_by_length (bool): Whether to form the batches of sources with a
+            ``modality_length`` from samples of similar length (and the same
+            modality), to reduce padding. Defaults to False.
+        mega_batch_mult (int): Number of batches whose samples are sorted by
+            length together. Defaults to 50.
+        shuffle_mode (str): ``'randperm'`` materializes a full permutation of
+            every source on every rank at every epoch. ``'feistel'`` computes
+            only the indices of the rank, in chunks, with a
+            :class:`FeistelPermutation`, for very large sources. Both yield
+            disjoint rank shares of the same seeded stream on all ranks, but
+            the two streams differ. Defaults to ``'randperm'``.
     """
 
     def __init__(self,
@@ -26,7 +89,10 @@ class FixedBatchMultiSourceSampler(Sampler):
                  dataset: Sized,
                  batch_size: int,
                  shuffle: bool = True,
-                 seed: Optional[int] = None) -> None:
+                 seed: Optional[int] = None,
+                 group_by_length: bool = False,
+                 mega_batch_mult: int = 50,
+                 shuffle_mode: str = 'randperm') -> None:
 
         assert hasattr(dataset, 'cumulative_sizes'),\
             f'The dataset must be ConcatDataset, but get {dataset}'
@@ -36,6 +102,8 @@ class FixedBatchMultiSourceSampler(Sampler):
         assert len(repeat) == len(dataset.cumulative_sizes), \
             'The length of repeat must be equal to ' \
             f'the number of datasets, but got repeat={repeat}'
+        assert shuffle_mode in ('randperm', 'feistel'), \
+            f'shuffle_mode must be randperm or feistel, but got {shuffle_mode}'
 
         rank, world_size = get_dist_info()
         self.rank = rank
@@ -48,10 +116,19 @@ class FixedBatchMultiSourceSampler(Sampler):
 
         self.seed = sync_random_seed() if seed is None else seed
         self.shuffle = shuffle
-        self.source2inds = {
-            source: self._indices_of_rank(len(ds))
-            for source, ds in enumerate(dataset.datasets)
-        }
+        self.group_by_length = group_by_length
+        self.mega_batch_mult = mega_batch_mult
+        self.shuffle_mode = shuffle_mode
+        self.source2inds = {}
+        for source, ds in enumerate(dataset.datasets):
+            if shuffle_mode == 'feistel':
+                indices = self._lazy_indices_of_rank(len(ds))
+            else:
+                indices = self._indices_of_rank(len(ds))
+            if group_by_length and hasattr(ds, 'modality_length'):
+                indices = self._length_grouped_indices(
+                    indices, ds.modality_length)
+            self.source2inds[source] = indices
 
     def _infinite_indices(self, sample_size: int) -> Iterator[int]:
         """Infinitely yield a sequence of indices."""
@@ -69,6 +146,51 @@ class FixedBatchMultiSourceSampler(Sampler):
             self._infinite_indices(sample_size), self.rank, None,
             self.world_size)
 
+    def _lazy_indices_of_rank(self,
+                              sample_size: int,
+                              chunk_size: int = 65536) -> Iterator[int]:
+        """Yield the same share of an infinite index stream as
+        ``_indices_of_rank``, i.e. every ``world_size``-th position starting
+        at ``rank``, without materializing the epochs."""
+        g = torch.Generator()
+        g.manual_seed(self.seed)
+        # position of the next index of the rank within the current epoch
+        offset = self.rank
+        while True:
+            permutation = FeistelPermutation(sample_size, g)
+            step = self.world_size * chunk_size
+            for start in range(offset, sample_size, step):
+                positions = np.arange(start, min(start + step, sample_size),
+                                      self.world_size)
+                if self.shuffle:
+                    positions = permutation(positions)
+                yield from positions.tolist()
+            offset = (offset - sample_size) % self.world_size
+
+    def _length_grouped_indices(self, indices: Iterator[int],
+                                lengths) -> Iterator[int]:
+        """Regroup the indices of a rank into batches of similar length.
+
+        Every ``mega_batch_mult`` batches of indices are sorted by length
+        (negative lengths, i.e. text-only samples, sort apart from the
+        others) and split into batches again, which are yielded in random
+        order.
+        """
+        lengths = torch.as_tensor(lengths)
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.rank)
+        mega_batch_size = self.batch_size * max(
+            min(self.mega_batch_mult,
+                len(lengths) // (self.batch_size * self.world_size)), 1)
+        while True:
+            mega_batch = torch.tensor(
+                list(itertools.islice(indices, mega_batch_size)))
+            mega_batch = mega_batch[torch.argsort(
+                lengths[mega_batch], descending=True)]
+            batches = mega_batch.split(self.batch_size)
+            for i in torch.randperm(len(batches), generator=g).tolist():
+                yield from batches[i].tolist()
+
     def __len__(self) -> int:
         return len(self.dataset)
 
@@ -188,4 +188,51 @@ class MidJourneyDataset(Text2ImageDataset):
             print(f"Error when processing index {idx}: {e}", flush=True)
             import traceback
             traceback.print_exc()
-            return self._retry()
\ No newline at end of file
+            return self._retry()
+
+class CachedLatentText2ImageDataset(Text2ImageDataset):
+    """Text-to-image pairs whose images were encoded once by
+    `scripts/cache_latents.py`. Yields `latents` instead of `pixel_values`, so
+    that `HarmonDev.text2image_loss` skips image decoding and the VAE. The
+    captions are tokenized (and dropped for `unconditional`) as usual.
+
+    Args:
+        data_path (str): folder of the latent store.
+        random_flip (bool): pick the latent of the flipped image half of the
+            time, if the store has one.
+    """
+
+    def __init__(self, data_path, local_folder=None, image_size=None, random_flip=True, **kwargs):
+        self.data_path = data_path
+        self.random_flip = random_flip
+        self._shards = {}
+        super().__init__(data_path=data_path, local_folder=local_folder, image_size=image_size, **kwargs)
+
+    def _load_data(self, data_path):
+        with open(os.path.join(data_path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.shard_offsets = np.cumsum([0] + self.meta['shard_sizes'])
+        self.data_list = []
+        for shard in range(len(self.meta['shard_sizes'])):
+            with open(os.path.join(data_path, f'captions_{shard:05d}.jsonl')) as f:
+                self.data_list += [json.loads(line) for line in f]
+        assert len(self.data_list) == self.shard_offsets[-1]
+
+        print(f"Load {len(self.data_list)} cached latents from {data_path}", flush=True)
+
+    def _get_shard(self, shard):
+        # memory-mapped lazily, so that every dataloader worker maps its own
+        if shard not in self._shards:
+            self._shards[shard] = np.load(os.path.join(self.data_path, f'latents_{shard:05d}.npy'),
+                                          mmap_mode='r')
+        return self._shards[shard]
+
+    def __getitem__(self, idx):
+        shard = int(np.searchsorted(self.shard_offsets, idx, side='right')) - 1
+        latents = self._get_shard(shard)[idx - self.shard_offsets[shard]]    # views c h w
+        view = random.randrange(len(latents)) if self.random_flip else 0
+
+        data = dict(latents=torch.from_numpy(np.array(latents[view])))
+        data.update(self._process_text(self.data_list[idx]))
+        data.update(type='text2image')
+        return data
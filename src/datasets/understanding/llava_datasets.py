@@ -106,16 +106,25 @@ class LLaVADataset(Dataset):
         else:
             self.image_processor = image_processor
         self.pad_image_to_square = pad_image_to_square
+        self._modality_length = None
 
     @property
     def modality_length(self):
-        length_list = []
-        for data_dict in self.text_data:
-            cur_len = len(data_dict['input_ids'])
-            if data_dict.get('image', None) is None:
-                cur_len = -cur_len
-            length_list.append(cur_len)
-        return length_list
+        """Token lengths of the samples as an array, negative for text-only
+        samples. Read column-wise on first use and cached."""
+        if self._modality_length is None:
+            if 'length' in self.text_data.column_names:
+                length = np.asarray(self.text_data['length'])
+            else:
+                length = np.asarray(self.text_data.map(
+                    lambda batch: {'length': [len(input_ids) for input_ids in batch['input_ids']]},
+                    batched=True, remove_columns=self.text_data.column_names)['length'])
+            if 'image' in self.text_data.column_names:
+                has_image = np.array([image is not None for image in self.text_data['image']])
+            else:
+                has_image = np.zeros(len(length), dtype=bool)
+            self._modality_length = np.where(has_image, length, -length)
+        return self._modality_length
 
     def __len__(self):
         return len(self.text_data)
@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+class AsyncDecoder:
+    """VAE-decodes generated latents on a worker thread, so that the decode (and
+    whatever `callback` does with the images, e.g. saving them) overlaps with the
+    MAR steps of the next batch. On CUDA the decode runs on its own stream.
+
+    Args:
+        model (Harmon): the model.
+        batch_size (int): micro-batch size of the decode, see `Harmon.decode`.
+        max_pending (int): number of batches that may wait for their decode;
+            `submit` blocks beyond it, which bounds the memory held by pending
+            latents.
+    """
+
+    def __init__(self, model, batch_size=None, max_pending=2):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.stream = torch.cuda.Stream(device=model.device) if model.device.type == 'cuda' else None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
+
+    def _decode(self, tokens, callback):
+        if self.stream is None:
+            return callback(self.model.decode(tokens, batch_size=self.batch_size))
+        with torch.cuda.stream(self.stream):
+            images = self.model.decode(tokens, batch_size=self.batch_size)
+        self.stream.synchronize()
+        return callback(images)
+
+    def submit(self, tokens, callback):
+        """Decode [b, m, n, c] latent tokens and call `callback(images)` on the
+        worker thread. Returns a future of the callback's result."""
+        while len(self._futures) >= self.max_pending:
+            self._futures.pop(0).result()
+        if self.stream is not None:
+            # the tokens are produced on the current stream, and must stay alive until the decode is done
+            self.stream.wait_stream(torch.cuda.current_stream(self.model.device))
+            tokens.record_stream(self.stream)
+        future = self._executor.submit(self._decode, tokens, callback)
+        self._futures.append(future)
+        return future
+
+    def close(self):
+        """Wait for the pending decodes, raising their errors."""
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        self._executor.shutdown()
@@ -0,0 +1,167 @@
+import os
+import hashlib
+import itertools
+from collections import OrderedDict
+
+import torch
+from transformers.cache_utils import DynamicCache
+
+
+class StaticPrefixCache(DynamicCache):
+    """KV cache backed by preallocated per-layer buffers.
+
+    The first `prefix_len` positions hold the prompt keys/values. The
+    remaining `max_new_tokens` positions are a scratch region: every forward
+    pass writes its keys/values right after the prompt, overwriting whatever
+    the previous pass left there. The prompt is therefore never grown or
+    truncated, and no `torch.cat` happens inside the cache.
+    """
+
+    def __init__(self, prefix_len, max_new_tokens):
+        super().__init__()
+        self.prefix_len = prefix_len
+        self.max_new_tokens = max_new_tokens
+        self._seen_tokens = prefix_len
+
+    @classmethod
+    def from_prefix(cls, past_key_values, max_new_tokens):
+        """Copy a filled prompt cache (`DynamicCache` or legacy tuples) into
+        preallocated buffers with room for `max_new_tokens` extra tokens."""
+        prefix_len = past_key_values[0][0].shape[-2]
+        cache = cls(prefix_len, max_new_tokens)
+        for keys, values in past_key_values:
+            b, h, _, d = keys.shape
+            key_buffer = keys.new_empty(b, h, prefix_len + max_new_tokens, d)
+            value_buffer = values.new_empty(b, h, prefix_len + max_new_tokens, d)
+            key_buffer[:, :, :prefix_len] = keys
+            value_buffer[:, :, :prefix_len] = values
+            cache.key_cache.append(key_buffer)
+            cache.value_cache.append(value_buffer)
+        return cache
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        new_len = key_states.shape[-2]
+        assert new_len <= self.max_new_tokens, \
+            f'{new_len} new tokens do not fit in a scratch region of {self.max_new_tokens}'
+        end = self.prefix_len + new_len
+        self.key_cache[layer_idx][:, :, self.prefix_len:end] = key_states
+        self.value_cache[layer_idx][:, :, self.prefix_len:end] = value_states
+
+        return self.key_cache[layer_idx][:, :, :end], self.value_cache[layer_idx][:, :, :end]
+
+    def batch_select(self, indices):
+        """A cache over the selected batch rows. With a slice, its buffers are
+        views of this cache's buffers."""
+        cache = StaticPrefixCache(self.prefix_len, self.max_new_tokens)
+        cache.key_cache = [keys[indices] for keys in self.key_cache]
+        cache.value_cache = [values[indices] for values in self.value_cache]
+        return cache
+
+    def get_seq_length(self, layer_idx=0):
+        # every pass starts right after the prompt
+        return self.prefix_len
+
+    def get_max_length(self):
+        return self.prefix_len + self.max_new_tokens
+
+
+class PrefixKVCache:
+    """Process-wide cache of prompt KV, keyed by token ids.
+
+    Entries hold the per-layer keys/values of a full prompt. A lookup returns
+    the longest prefix that some entry shares with the query, so the chat
+    template prefix and repeated prompts (e.g. the cfg prompt) are only ever
+    run through the LLM once. Entries are evicted in LRU order once the
+    in-memory budget is exceeded; with `disk_dir` they are moved to disk
+    first and evicted from there once `max_disk_bytes` is exceeded.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        # token ids -> tuple of (keys, values) of shape [num_heads, len, head_dim]
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        # token ids -> (path, num_bytes)
+        self.disk_entries = OrderedDict()
+        self.num_disk_bytes = 0
+        self.hits = self.misses = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def _nbytes(past_key_values):
+        return sum(keys.numel() * keys.element_size() + values.numel() * values.element_size()
+                   for keys, values in past_key_values)
+
+    def lookup(self, token_ids, device=None):
+        """Return `(prefix_len, past_key_values)` for the longest cached prefix of
+        `token_ids`, with `past_key_values` a tuple of `[1, h, prefix_len, d]`
+        (keys, values) per layer, or `(0, None)` if nothing matches."""
+        token_ids = tuple(token_ids)
+        best_key, best_len = None, 0
+        for key in itertools.chain(self.entries, self.disk_entries):
+            prefix_len = len(os.path.commonprefix([key, token_ids]))
+            if prefix_len > best_len:
+                best_key, best_len = key, prefix_len
+                if prefix_len == len(token_ids):
+                    break
+        if best_key is None:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+
+        if best_key in self.entries:
+            self.entries.move_to_end(best_key)
+            past_key_values = self.entries[best_key]
+        else:
+            path, _ = self.disk_entries[best_key]
+            past_key_values = torch.load(path, map_location=device)
+            self._insert(best_key, past_key_values)
+        return best_len, tuple((keys[None, :, :best_len].to(device), values[None, :, :best_len].to(device))
+                               for keys, values in past_key_values)
+
+    def insert(self, token_ids, past_key_values):
+        """Store the KV (`DynamicCache` or legacy tuples with a batch size of 1)
+        of the prompt `token_ids`."""
+        token_ids = tuple(token_ids)
+        past_key_values = tuple((keys[0, :, :len(token_ids)].detach().clone(),
+                                 values[0, :, :len(token_ids)].detach().clone())
+                                for keys, values in past_key_values)
+        # an entry whose prompt is a prefix of the new one is superseded by it
+        for key in [key for key in self.entries if token_ids[:len(key)] == key]:
+            self.num_bytes -= self._nbytes(self.entries.pop(key))
+        for key in [key for key in self.disk_entries if token_ids[:len(key)] == key]:
+            self._remove_from_disk(key)
+        self._insert(token_ids, past_key_values)
+
+    def _insert(self, token_ids, past_key_values):
+        if token_ids in self.entries:
+            self.num_bytes -= self._nbytes(self.entries.pop(token_ids))
+        self.entries[token_ids] = past_key_values
+        self.num_bytes += self._nbytes(past_key_values)
+        while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+            key, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= self._nbytes(evicted)
+            if self.disk_dir is not None:
+                self._offload(key, evicted)
+
+    def _offload(self, token_ids, past_key_values):
+        if token_ids not in self.disk_entries:
+            name = hashlib.sha1(str(token_ids).encode()).hexdigest()
+            path = os.path.join(self.disk_dir, f'{name}.pt')
+            torch.save(tuple((keys.cpu(), values.cpu()) for keys, values in past_key_values), path)
+            num_bytes = self._nbytes(past_key_values)
+            self.disk_entries[token_ids] = (path, num_bytes)
+            self.num_disk_bytes += num_bytes
+        self.disk_entries.move_to_end(token_ids)
+        while self.max_disk_bytes is not None and self.num_disk_bytes > self.max_disk_bytes \
+                and len(self.disk_entries) > 0:
+            self._remove_from_disk(next(iter(self.disk_entries)))
+
+    def _remove_from_disk(self, token_ids):
+        path, num_bytes = self.disk_entries.pop(token_ids)
+        self.num_disk_bytes -= num_bytes
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,293 @@
+import itertools
+from collections import deque
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from src.models.cache_utils import StaticPrefixCache
+from src.models.harmon import mask_schedule
+from src.models.random_utils import make_generators
+
+
+class GenerationRequest:
+    """State of one text-to-image generation inside the running batch.
+
+    A request with `cfg != 1.0` occupies two rows of the batch (conditional and
+    unconditional). Both rows share `tokens`, `mask` and `orders`, which are
+    kept here for a single image. Its generation order and diffusion noise come
+    from its own `generator`, so the image does not depend on the other requests
+    it is batched with.
+    """
+
+    def __init__(self, request_id, input_ids, cfg_input_ids, num_iter, cfg, cfg_schedule, temperature,
+                 generator):
+        self.request_id = request_id
+        self.input_ids = input_ids
+        self.cfg_input_ids = cfg_input_ids
+        self.num_iter = num_iter
+        self.cfg = cfg
+        self.cfg_schedule = cfg_schedule
+        self.temperature = temperature
+        self.generator = generator
+
+        self.step = 0
+        self.schedule = None
+        self.tokens = None
+        self.mask = None
+        self.orders = None
+        # per-row prompt caches, a tuple of (keys, values) per layer
+        self.past_key_values = None
+        self.cfg_past_key_values = None
+
+    @property
+    def use_cfg(self):
+        return self.cfg != 1.0
+
+    @property
+    def num_rows(self):
+        return 2 if self.use_cfg else 1
+
+    @property
+    def finished(self):
+        return self.step >= self.num_iter
+
+
+class ContinuousBatchingScheduler:
+    """Continuous batching for `Harmon` text-to-image generation.
+
+    Keeps a running batch of in-flight generations and advances each of them by
+    one MAR step per `step()` call. New requests join and finished ones are
+    VAE-decoded and retired at step boundaries, so the batch does not wait for
+    its slowest member. Every request keeps its own mask schedule, generation
+    order, CFG scale and temperature; the image shape is shared by all requests
+    of a scheduler.
+
+    The MAR step runs through `Harmon.mar_step_padded`, which keeps masked tokens
+    in the sequence, so rows at different points of their schedules can share a
+    batch.
+
+    Args:
+        model (Harmon): the model.
+        image_shape (tuple): latent (m, n) of all generated images.
+        max_batch_size (int): maximum number of batch rows. A request with CFG
+            takes two rows.
+        cfg_prompt (str): prompt of the unconditional branch.
+        prefix_cache (PrefixKVCache): optional prompt KV cache shared across
+            requests.
+        diffusion_sampler (str): sampler of the diffusion head, see
+            `DiffLoss.sample`.
+        diffusion_steps (int): diffusion steps per MAR step.
+    """
+
+    def __init__(self, model, image_shape=(32, 32), max_batch_size=16, cfg_prompt='Generate an image.',
+                 prefix_cache=None, diffusion_sampler='ddpm', diffusion_steps=None):
+        self.model = model
+        self.image_shape = tuple(image_shape)
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.diffusion_sampler = diffusion_sampler
+        self.diffusion_steps = diffusion_steps
+        self.cfg_input_ids = self._tokenize(cfg_prompt)
+
+        self._request_ids = itertools.count()
+        self.waiting = deque()
+        self.running = []
+
+        # batched prompt cache and attention mask, rebuilt when the running set changes
+        self._past_key_values = None
+        self._attention_mask = None
+
+    @property
+    def seq_len(self):
+        return self.image_shape[0] * self.image_shape[1]
+
+    def _tokenize(self, prompt):
+        prompt = self.model.prompt_template['INSTRUCTION'].format(input=prompt)
+        return self.model.tokenizer.encode(prompt, add_special_tokens=True, return_tensors='pt')[0]
+
+    def add_request(self, prompt, num_iter=64, cfg=1.0, cfg_schedule='constant', temperature=1.0, seed=None):
+        """Queue a prompt. It joins the running batch at the next step boundary
+        with free rows. `seed` (an int or a `torch.Generator`) fixes the random
+        stream of the request, by default it is drawn from the global RNG.
+        Returns the request id."""
+        assert cfg_schedule in ('linear', 'constant')
+        assert (2 if cfg != 1.0 else 1) <= self.max_batch_size
+        if seed is None:
+            seed = int(torch.randint(2 ** 62, ()))
+        request = GenerationRequest(request_id=next(self._request_ids),
+                                    input_ids=self._tokenize(prompt),
+                                    cfg_input_ids=self.cfg_input_ids,
+                                    num_iter=num_iter, cfg=cfg, cfg_schedule=cfg_schedule,
+                                    temperature=temperature,
+                                    generator=make_generators([seed], 1, self.model.device)[0])
+        self.waiting.append(request)
+        return request.request_id
+
+    def has_unfinished_requests(self):
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    @torch.no_grad()
+    def _prefill(self, input_ids):
+        """Prompt caches of a list of unpadded prompts, one tuple of (keys, values)
+        per layer and prompt, each trimmed to the prompt length."""
+        model = self.model
+        lengths = [len(input_ids_) for input_ids_ in input_ids]
+        # right padding keeps the causal prefill of every prompt exact
+        input_ids = pad_sequence(input_ids, batch_first=True,
+                                 padding_value=model.tokenizer.eos_token_id).to(model.device)
+        attention_mask = torch.zeros_like(input_ids).bool()
+        for i, length in enumerate(lengths):
+            attention_mask[i, :length] = True
+        past_key_values = model.prefill(input_ids=input_ids, attention_mask=attention_mask,
+                                        prefix_cache=self.prefix_cache)
+        return [tuple((keys[i:i+1, :, :length], values[i:i+1, :, :length])
+                      for keys, values in past_key_values)
+                for i, length in enumerate(lengths)]
+
+    def _admit(self):
+        num_rows = sum(request.num_rows for request in self.running)
+        admitted = []
+        while len(self.waiting) > 0 and num_rows + self.waiting[0].num_rows <= self.max_batch_size:
+            request = self.waiting.popleft()
+            num_rows += request.num_rows
+            admitted.append(request)
+        if len(admitted) == 0:
+            return False
+
+        model = self.model
+        prompts = [request.input_ids for request in admitted]
+        prompts += [request.cfg_input_ids for request in admitted if request.use_cfg]
+        past_key_values = self._prefill(prompts)
+        cfg_past_key_values = iter(past_key_values[len(admitted):])
+        for request, past_key_values_ in zip(admitted, past_key_values):
+            request.past_key_values = past_key_values_
+            if request.use_cfg:
+                request.cfg_past_key_values = next(cfg_past_key_values)
+            request.schedule = mask_schedule(self.seq_len, request.num_iter)
+            request.tokens = torch.zeros(self.seq_len, model.token_embed_dim,
+                                         device=model.device, dtype=model.dtype)
+            request.mask = torch.ones(self.seq_len, device=model.device, dtype=model.dtype)
+            request.orders = model.mar.sample_orders(1, seq_len=self.seq_len, generator=[request.generator])[0]
+
+        self.running.extend(admitted)
+        return True
+
+    def _rows(self):
+        """The running requests of each batch row and whether the row is unconditional.
+        Conditional rows come first, followed by the unconditional rows of CFG requests."""
+        rows = [(request, False) for request in self.running]
+        rows += [(request, True) for request in self.running if request.use_cfg]
+        return rows
+
+    def _build_batch_cache(self):
+        rows = self._rows()
+        row_caches = [request.cfg_past_key_values if uncond else request.past_key_values
+                      for request, uncond in rows]
+        lengths = [row_cache[0][0].shape[-2] for row_cache in row_caches]
+        prefix_len = max(lengths)
+
+        past_key_values = []
+        for layer_idx in range(len(row_caches[0])):
+            keys, values = zip(*[row_cache[layer_idx] for row_cache in row_caches])
+            b, h, _, d = keys[0].shape
+            batch_keys = keys[0].new_zeros(len(rows), h, prefix_len, d)
+            batch_values = values[0].new_zeros(len(rows), h, prefix_len, d)
+            for i, (keys_, values_) in enumerate(zip(keys, values)):
+                batch_keys[i, :, :lengths[i]] = keys_[0]
+                batch_values[i, :, :lengths[i]] = values_[0]
+            past_key_values.append((batch_keys, batch_values))
+
+        self._past_key_values = StaticPrefixCache.from_prefix(
+            past_key_values, max_new_tokens=self.model.mar.buffer_size + self.seq_len)
+        attention_mask = torch.zeros(len(rows), prefix_len, dtype=torch.bool, device=self.model.device)
+        for i, length in enumerate(lengths):
+            attention_mask[i, :length] = True
+        self._attention_mask = attention_mask
+
+    def _retire(self):
+        finished = [request for request in self.running if request.finished]
+        if len(finished) == 0:
+            return []
+        self.running = [request for request in self.running if not request.finished]
+
+        m, n = self.image_shape
+        tokens = torch.stack([request.tokens for request in finished])
+        images = self.model.decode(tokens.view(len(finished), m, n, -1))
+
+        return [(request.request_id, image) for request, image in zip(finished, images)]
+
+    @torch.no_grad()
+    def step(self):
+        """Advance every running request by one MAR step. Returns a list of
+        `(request_id, image)` for the requests that finished in this step."""
+        changed = self._admit()
+        if len(self.running) == 0:
+            return []
+        if changed or self._past_key_values is None:
+            self._build_batch_cache()
+
+        model = self.model
+        rows = self._rows()
+        tokens = torch.stack([request.tokens for request, _ in rows])
+        mask = torch.stack([request.mask for request, _ in rows])
+        z = model.mar_step_padded(tokens, mask, self._past_key_values, self._attention_mask, self.image_shape)
+
+        # locations to predict in this step for every request, in raster order
+        row_index = {(request.request_id, uncond): i for i, (request, uncond) in enumerate(rows)}
+        pred_idx = {}
+        for request in self.running:
+            start, end, mask_len = request.schedule[request.step]
+            pred_idx[request.request_id] = request.orders[start:end].sort().values
+
+        def gather(requests, uncond=False):
+            return torch.cat([z[row_index[(request.request_id, uncond)], pred_idx[request.request_id]]
+                              for request in requests])
+
+        def per_token(requests, values):
+            return torch.cat([z.new_full((len(pred_idx[request.request_id]), 1), value, dtype=torch.float32)
+                              for request, value in zip(requests, values)])
+
+        def cfg_scale(request):
+            # cfg schedule follow Muse
+            if request.cfg_schedule == 'linear':
+                mask_len = request.schedule[request.step][2]
+                return 1 + (request.cfg - 1) * (self.seq_len - mask_len) / self.seq_len
+            return request.cfg
+
+        sampled = {}
+        requests = [request for request in self.running if len(pred_idx[request.request_id]) > 0]
+        cfg_requests = [request for request in requests if request.use_cfg]
+        plain_requests = [request for request in requests if not request.use_cfg]
+        if len(cfg_requests) > 0:
+            z_cfg = torch.cat([gather(cfg_requests), gather(cfg_requests, uncond=True)])
+            temperature = per_token(cfg_requests, [request.temperature for request in cfg_requests])
+            cfg = per_token(cfg_requests, [cfg_scale(request) for request in cfg_requests])
+            sampled_token_latent = model.mar.diffloss.sample(
+                z_cfg, temperature.repeat(2, 1), cfg, sampler=self.diffusion_sampler,
+                num_steps=self.diffusion_steps, generator=[request.generator for request in cfg_requests],
+                group_sizes=[len(pred_idx[request.request_id]) for request in cfg_requests]
+            )[:len(cfg)].to(model.dtype)
+            sampled.update(zip([request.request_id for request in cfg_requests],
+                               sampled_token_latent.split([len(pred_idx[request.request_id])
+                                                           for request in cfg_requests])))
+        if len(plain_requests) > 0:
+            temperature = per_token(plain_requests, [request.temperature for request in plain_requests])
+            sampled_token_latent = model.mar.diffloss.sample(
+                gather(plain_requests), temperature, sampler=self.diffusion_sampler,
+                num_steps=self.diffusion_steps, generator=[request.generator for request in plain_requests],
+                group_sizes=[len(pred_idx[request.request_id]) for request in plain_requests]
+            ).to(model.dtype)
+            sampled.update(zip([request.request_id for request in plain_requests],
+                               sampled_token_latent.split([len(pred_idx[request.request_id])
+                                                           for request in plain_requests])))
+
+        for request in self.running:
+            if request.request_id in sampled:
+                request.tokens[pred_idx[request.request_id]] = sampled[request.request_id]
+                request.mask[pred_idx[request.request_id]] = 0
+            request.step += 1
+
+        finished = self._retire()
+        if len(finished) > 0:
+            self._past_key_values = None
+        return finished
@@ -0,0 +1,45 @@
+import torch
+import torch.nn as nn
+
+# sub-modules of Harmon that `quantize_dynamic_int8` can quantize
+QUANTIZABLE_COMPONENTS = ('llm', 'mar', 'diffloss')
+
+
+def set_cpu_threads(num_threads=None, num_interop_threads=None):
+    """Configure intra-op and inter-op parallelism. Must be called before the
+    first parallel op runs, i.e. before the model is built."""
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
+
+
+def cpu_model_config(model_config):
+    """Adapt a Harmon model config for CPU inference: the LLM is loaded in float32
+    with SDPA attention, as flash attention and bf16 matmuls are GPU-only or slow
+    on most CPUs."""
+    model_config.llm.update(torch_dtype=torch.float32, attn_implementation='sdpa')
+    return model_config
+
+
+def quantize_dynamic_int8(model, components=QUANTIZABLE_COMPONENTS):
+    """Dynamic int8 quantization of the linear layers of a float32 Harmon on CPU.
+
+    Weights are stored as int8 and activations are quantized on the fly, so no
+    calibration is needed. Quantize after loading the checkpoint, the quantized
+    modules do not load float state dicts.
+
+    Args:
+        model (Harmon): the model, in float32.
+        components (tuple): any of 'llm' (the Qwen2 decoder layers and head),
+            'mar' (the MAR encoder and decoder blocks) and 'diffloss' (the
+            SimpleMLPAdaLN head).
+    """
+    assert model.device.type == 'cpu', 'dynamic quantization runs on CPU only'
+    targets = dict(llm=[model.llm],
+                   mar=[model.mar.encoder_blocks, model.mar.decoder_blocks],
+                   diffloss=[model.mar.diffloss.net])
+    for component in components:
+        for module in targets[component]:
+            torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
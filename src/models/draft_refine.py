@@ -0,0 +1,34 @@
+import torch
+
+
+@torch.no_grad()
+def sample_draft_then_refine(draft_model, refine_model, input_ids, attention_mask, switch_step,
+                             num_iter=64, generator=None, draft_prefix_cache=None, refine_prefix_cache=None,
+                             **kwargs):
+    """Text-to-image sampling with two Harmon models of the same VAE latent space.
+
+    The MAR steps `[0, switch_step)` of the mask schedule run on `draft_model`
+    (e.g. Harmon-0.5B), where few tokens are visible and a small model suffices.
+    The partially generated tokens, the mask, the generation orders and the
+    random streams are then handed to `refine_model` (e.g. Harmon-1.5B), which
+    runs the remaining steps and decodes the images. `switch_step=0` samples with
+    `refine_model` only, `switch_step=num_iter` with `draft_model` only (still
+    decoded by `refine_model`).
+
+    Both models must share the tokenizer and prompt template, as the prompts are
+    tokenized once. A `PrefixKVCache` holds the KV of one model only, so each
+    model takes its own (`draft_prefix_cache`, `refine_prefix_cache`). Other
+    keyword arguments go to `Harmon.sample` of both models.
+    """
+    assert 'prefix_cache' not in kwargs, \
+        'pass draft_prefix_cache and refine_prefix_cache, the models cannot share a prefix cache'
+    assert 0 <= switch_step <= num_iter
+    assert draft_model.token_embed_dim == refine_model.token_embed_dim, \
+        'draft and refine models must share the VAE latent space'
+    state = draft_model.sample(input_ids=input_ids, attention_mask=attention_mask, num_iter=num_iter,
+                               generator=generator, stop_step=switch_step, return_state=True,
+                               prefix_cache=draft_prefix_cache, **kwargs)
+    return refine_model.sample(input_ids=input_ids, attention_mask=attention_mask, num_iter=num_iter,
+                               generator=state['generator'], tokens=state['tokens'], mask=state['mask'],
+                               orders=state['orders'], start_step=state['step'],
+                               prefix_cache=refine_prefix_cache, **kwargs)
@@ -5,6 +5,8 @@ import torch.nn as nn
 from einops import rearrange
 from transformers.cache_utils import DynamicCache
 from src.builder import BUILDER
+from src.models.cache_utils import StaticPrefixCache
+from src.models.random_utils import make_generators
 from tqdm import tqdm
 from torch.nn.utils.rnn import pad_sequence
 
@@ -23,6 +25,27 @@ def mask_by_order(mask_len, order, bsz, seq_len):
     return masking
 
 
+def mask_schedule(seq_len, num_iter):
+    """The cosine mask schedule of `Harmon.sample`, computed on the host.
+
+    Starting from a fully masked sequence, step i predicts the tokens at
+    `order[start:end]` of each row's generation order. Returns a list of
+    `(start, end, mask_len)` with `mask_len` the number of tokens that stay
+    masked after the step (as used by the linear cfg schedule).
+    """
+    schedule = []
+    cur_len = seq_len
+    for step in range(num_iter):
+        # mask ratio for the next round, following MaskGIT and MAGE.
+        mask_ratio = np.cos(math.pi / 2. * (step + 1) / num_iter)
+        # masks out at least one for the next iteration
+        mask_len = max(1, min(cur_len - 1, int(np.floor(seq_len * mask_ratio))))
+        start = 0 if step >= num_iter - 1 else mask_len
+        schedule.append((start, cur_len, mask_len))
+        cur_len = mask_len
+    return schedule
+
+
 class Harmon(nn.Module):
     def __init__(self,
                  vae,
@@ -30,12 +53,23 @@ class Harmon(nn.Module):
                  llm,
                  mar,
                  tokenizer,
-                 prompt_template):
+                 prompt_template,
+                 preview_decoder=None,
+                 vae_tile_size=None,
+                 vae_tile_overlap=64):
         super().__init__()
         # VAE
         self.vae = BUILDER.build(vae)
         self.vae.requires_grad_(False)
         self.vae_scale = vae_scale
+        # tiled VAE encode and decode for large images, see encode and decode
+        self.vae_tile_size = vae_tile_size
+        self.vae_tile_overlap = vae_tile_overlap
+        # optional cheap latent-to-RGB decoder, see decode(preview=True)
+        self.preview_decoder = None
+        if preview_decoder is not None:
+            self.preview_decoder = BUILDER.build(preview_decoder)
+            self.preview_decoder.requires_grad_(False)
 
         # LLM
         self.llm = BUILDER.build(llm)
@@ -73,21 +107,45 @@ class Harmon(nn.Module):
         return self.vae.embed_dim * (self.mar.patch_size ** 2)
 
     @torch.no_grad()
-    def encode(self, x):
-        posterior = self.vae.encode(x)
-        z = posterior.mode().mul_(self.vae_scale)
+    def encode(self, x, tile_size=None, tile_overlap=None):
+        """Encode images into [b, m, n, c] latent tokens. Images larger than
+        `tile_size` pixels (default `vae_tile_size`, None disables tiling) are
+        encoded in tiles overlapping by `tile_overlap` pixels."""
+        tile_size = self.vae_tile_size if tile_size is None else tile_size
+        tile_overlap = self.vae_tile_overlap if tile_overlap is None else tile_overlap
+        posterior = self.vae.encode(x, tile_size=tile_size, tile_overlap=tile_overlap)
+
+        return self.latents_to_tokens(posterior.mode())
+
+    def latents_to_tokens(self, z):
+        """Scale and patchify [b, c, h, w] VAE latents, e.g. those cached by
+        `scripts/cache_latents.py`, into the [b, m, n, c] tokens of `encode`."""
+        z = z * self.vae_scale
         z = rearrange(z, 'b c (m p) (n q) -> b m n (c p q)',
                       p=self.mar.patch_size, q=self.mar.patch_size)
 
         return z
 
     @torch.no_grad()
-    def decode(self, z):
-        z /= self.vae_scale
+    def decode(self, z, preview=False, tile_size=None, tile_overlap=None, batch_size=None):
+        """Decode [b, m, n, c] latent tokens into images. With `preview`, use the
+        lightweight `preview_decoder` instead of the VAE decoder. Images larger
+        than `tile_size` pixels are decoded in tiles, see `encode`, and
+        `batch_size` decodes the batch in micro-batches of that size, both of
+        which bound the peak activation memory."""
+        if batch_size is not None and len(z) > batch_size:
+            return torch.cat([self.decode(z_, preview=preview, tile_size=tile_size, tile_overlap=tile_overlap)
+                              for z_ in z.split(batch_size)])
+        z = z / self.vae_scale
         z = rearrange(z, 'b m n (c p q) -> b c (m p) (n q)',
                       p=self.mar.patch_size, q=self.mar.patch_size)
 
-        x = self.vae.decode(z)
+        if preview:
+            assert self.preview_decoder is not None, 'the model has no preview decoder'
+            return self.preview_decoder(z)
+        tile_size = self.vae_tile_size if tile_size is None else tile_size
+        tile_overlap = self.vae_tile_overlap if tile_overlap is None else tile_overlap
+        x = self.vae.decode(z, tile_size=tile_size, tile_overlap=tile_overlap)
         return x
 
     def prepare_forward_input(self,
@@ -95,11 +153,14 @@ class Harmon(nn.Module):
                               inputs_embeds=None,
                               input_ids=None,
                               attention_mask=None,
-                              past_key_values=None):
+                              past_key_values=None,
+                              x_mask=None):
         b, l, _ = x.shape
         attention_mask = attention_mask.to(device=self.device, dtype=torch.bool)
+        if x_mask is None:
+            x_mask = attention_mask.new_ones(b, l)
         attention_mask = torch.cat([
-            attention_mask, attention_mask.new_ones(b, l)
+            attention_mask, x_mask.to(attention_mask)
         ], dim=1)
         position_ids = torch.cumsum(attention_mask, dim=1) - 1
         position_ids[position_ids < 0] = 0
@@ -142,7 +203,7 @@ class Harmon(nn.Module):
 
         return x_enc, z_enc
 
-    def forward_mae_encoder(self, x, mask, detach=False, **context):
+    def forward_mae_encoder(self, x, mask, detach=False, return_residual=False, **context):
         b, m, n, _ = x.shape
         x_enc, z_enc = self.extract_visual_feature(x, mask=mask, detach=detach)
         inputs = self.prepare_forward_input(x=z_enc, **context)
@@ -150,6 +211,50 @@ class Harmon(nn.Module):
 
         z_llm = output.last_hidden_state[:, -z_enc.shape[1]:]
 
+        # move buffers back to the start of the image sequence
+        z_llm = torch.cat([
+            z_llm[:, -self.mar.buffer_size:],
+            z_llm[:, :-self.mar.buffer_size]], dim=1)
+
+        # residual learning
+        residual = self.proj_out(z_llm)
+        x_enc = x_enc + residual
+
+        if return_residual:
+            return x_enc, residual
+        return x_enc
+
+    def forward_mae_encoder_cached(self, x, mask, residual_cache):
+        """Run only the MAR encoder and reuse LLM residuals cached at full
+        resolution (buffer + m*n positions). Tokens that became visible after
+        the cache was filled get a zero residual."""
+        x_enc, _ = self.extract_visual_feature(x, mask=mask)
+        visible = torch.cat([self.mar.buffer_mask(mask.shape[0], mask.dtype, mask.device), mask], dim=1) == 0
+        residual = residual_cache[visible.nonzero(as_tuple=True)].view(*x_enc.shape)
+
+        return x_enc + residual
+
+    def forward_mae_encoder_padded(self, x, mask, **context):
+        """Shape-static variant of `forward_mae_encoder`. Masked image tokens stay
+        in the LLM input and are hidden by the attention mask instead of being
+        dropped, so the output is always [b, buffer_size + m*n, c]."""
+        b, m, n, _ = x.shape
+        x = x.view(b, m*n, -1)
+        null_embeds = self.mar.fake_latent.expand(b, -1)
+        x_enc = self.mar.forward_mae_encoder_padded(x, mask, null_embeds, image_shape=(m, n))
+
+        z_enc = self.proj_in(x_enc)
+        # Move buffers to the end of the image sequence
+        z_enc = torch.cat([
+            z_enc[:, self.mar.buffer_size:],
+            z_enc[:, :self.mar.buffer_size]], dim=1)
+        x_mask = torch.cat([1 - mask, self.mar.buffer_mask(b, mask.dtype, mask.device, value=1)], dim=1)
+
+        inputs = self.prepare_forward_input(x=z_enc, x_mask=x_mask, **context)
+        output = self.llm_model(**inputs, return_dict=True)
+
+        z_llm = output.last_hidden_state[:, -z_enc.shape[1]:]
+
         # move buffers back to the start of the image sequence
         z_llm = torch.cat([
             z_llm[:, -self.mar.buffer_size:],
@@ -160,6 +265,26 @@ class Harmon(nn.Module):
 
         return x_enc
 
+    def mar_step_padded(self, tokens, mask, past_key_values, attention_mask, image_shape, x_con=None):
+        """One shape-static MAR step (MAR encoder, LLM and MAR decoder) that
+        returns the diffusion conditions for all positions."""
+        m, n = image_shape
+        x_enc = self.forward_mae_encoder_padded(tokens.view(tokens.shape[0], m, n, -1), mask,
+                                                past_key_values=past_key_values,
+                                                attention_mask=attention_mask)
+        return self.mar.forward_mae_decoder_padded(x_enc, mask, image_shape=(m, n), x_con=x_con)
+
+    @staticmethod
+    def select_cache_rows(past_key_values, num_rows):
+        """A cache for the first `num_rows` rows of the batch, sharing memory with `past_key_values`."""
+        if num_rows == past_key_values[0][0].shape[0]:
+            return past_key_values
+        if isinstance(past_key_values, StaticPrefixCache):
+            return past_key_values.batch_select(slice(0, num_rows))
+        # the dynamic cache concatenates new keys/values into fresh tensors, the prompt stays untouched
+        return DynamicCache.from_legacy_cache(tuple((keys[:num_rows], values[:num_rows])
+                                                    for keys, values in past_key_values))
+
     @staticmethod
     def curtail_cache(past_key_values, cur_len):
         for past_key_values_ in past_key_values:
@@ -167,6 +292,90 @@ class Harmon(nn.Module):
             keys.data = keys.data[:, :, :cur_len]
             values.data = values.data[:, :, :cur_len]
 
+    @torch.no_grad()
+    def prefill(self, input_ids=None, inputs_embeds=None, attention_mask=None, dedup_prompts=True,
+                prefix_cache=None):
+        """Run the LLM over the prompts and return their KV cache.
+
+        Batches usually repeat prompts (several samples per prompt, one shared
+        cfg prompt for all unconditional rows). With `dedup_prompts`, the LLM
+        only runs on the unique rows of `input_ids` (and `attention_mask`) and
+        the cache is gathered back to the full batch. With a `PrefixKVCache`,
+        each prompt only runs the LLM on the tokens after its longest cached
+        prefix.
+        """
+        inverse = None
+        if dedup_prompts and input_ids is not None and inputs_embeds is None:
+            key = input_ids if attention_mask is None else torch.cat(
+                [input_ids, attention_mask.to(input_ids)], dim=1)
+            unique_key, inverse = torch.unique(key, dim=0, return_inverse=True)
+            if len(unique_key) < len(key):
+                input_ids = unique_key[:, :input_ids.shape[1]]
+                if attention_mask is not None:
+                    attention_mask = unique_key[:, input_ids.shape[1]:]
+            else:
+                inverse = None
+
+        if prefix_cache is not None and inputs_embeds is None:
+            past_key_values = self.prefill_with_prefix_cache(input_ids, attention_mask, prefix_cache)
+        else:
+            if inputs_embeds is None:
+                inputs_embeds = self.llm.get_input_embeddings()(input_ids.to(self.device))
+            output = self.llm_model(inputs_embeds=inputs_embeds,
+                                    attention_mask=None,
+                                    position_ids=None,
+                                    past_key_values=DynamicCache.from_legacy_cache(),
+                                    return_dict=True,
+                                    use_cache=True)
+            past_key_values = output.past_key_values
+        if inverse is None:
+            return past_key_values
+
+        inverse = inverse.to(self.device)
+        return DynamicCache.from_legacy_cache(tuple(
+            (keys.index_select(0, inverse), values.index_select(0, inverse))
+            for keys, values in past_key_values))
+
+    @torch.no_grad()
+    def prefill_with_prefix_cache(self, input_ids, attention_mask, prefix_cache):
+        """Prefill the prompts one by one from their longest prefix in `prefix_cache`.
+
+        Prompt positions after the last valid token (right padding) are masked
+        out during generation, so they are neither computed nor cached and are
+        left as zeros in the returned cache.
+        """
+        bsz, seq_len = input_ids.shape
+        row_caches = []
+        for i in range(bsz):
+            valid_len = seq_len
+            if attention_mask is not None:
+                valid_len = int(attention_mask[i].nonzero().max()) + 1
+            token_ids = input_ids[i, :valid_len].tolist()
+            prefix_len, past_key_values = prefix_cache.lookup(token_ids, device=self.device)
+            if prefix_len < valid_len:
+                output = self.llm_model(
+                    inputs_embeds=self.llm.get_input_embeddings()(input_ids[i:i+1, prefix_len:valid_len].to(self.device)),
+                    attention_mask=None,
+                    position_ids=None,
+                    past_key_values=DynamicCache.from_legacy_cache(past_key_values),
+                    return_dict=True,
+                    use_cache=True)
+                past_key_values = output.past_key_values.to_legacy_cache()
+                prefix_cache.insert(token_ids, past_key_values)
+            row_caches.append(past_key_values)
+
+        batch_cache = []
+        for layer_idx in range(len(row_caches[0])):
+            keys, values = row_caches[0][layer_idx]
+            batch_keys = keys.new_zeros(bsz, keys.shape[1], seq_len, keys.shape[-1])
+            batch_values = values.new_zeros(bsz, values.shape[1], seq_len, values.shape[-1])
+            for i, row_cache in enumerate(row_caches):
+                keys, values = row_cache[layer_idx]
+                batch_keys[i, :, :keys.shape[-2]] = keys[0]
+                batch_values[i, :, :values.shape[-2]] = values[0]
+            batch_cache.append((batch_keys, batch_values))
+        return DynamicCache.from_legacy_cache(tuple(batch_cache))
+
     @torch.no_grad()
     def prepare_text_conditions(self, prompt, cfg_prompt='Generate an image.'):
         all_prompts = [self.prompt_template['INSTRUCTION'].format(input=prompt),
@@ -185,16 +394,70 @@ class Harmon(nn.Module):
                     attention_mask=attention_mask.to(self.device))
 
     @torch.no_grad()
-    def sample(self,
-               input_ids=None, inputs_embeds=None,
-               attention_mask=None, num_iter=64, cfg=1.0, cfg_schedule="constant", temperature=1.0,
-               progress=False, mask=None, past_key_values=None, image_shape=None, x_con=None, **kwargs):
-        if inputs_embeds is None and input_ids is not None:
-            inputs_embeds = self.llm.get_input_embeddings()(input_ids)
+    def sample(self, *args, return_state=False, **kwargs):
+        """Generate images, see `sample_progressive` for the arguments, which keep their
+        positional order.
+        :param return_state: return the `tokens`, `mask`, `orders`, next `step` and `generator`
+            instead of decoding the images.
+        """
+        for out in self.sample_progressive(*args, yield_steps=(), decode=not return_state, **kwargs):
+            pass
+        if return_state:
+            return {key: out[key] for key in ('tokens', 'mask', 'orders', 'step', 'generator')}
+        return out['images']
 
+    @torch.no_grad()
+    def sample_progressive(self,
+                           input_ids=None, inputs_embeds=None,
+                           attention_mask=None, num_iter=64, cfg=1.0, cfg_schedule="constant", temperature=1.0,
+                           progress=False, mask=None, past_key_values=None, image_shape=None, x_con=None,
+                           static_cache=False, llm_refresh_interval=1, llm_refresh_threshold=None,
+                           dedup_prompts=True, prefix_cache=None, cfg_interval=None, cfg_interval_type='step',
+                           diffusion_sampler='ddpm', diffusion_steps=None, generator=None,
+                           tokens=None, orders=None, start_step=0, stop_step=None,
+                           yield_steps=None, preview=False, decode=True, decode_batch_size=None, **kwargs):
+        """Generator over the intermediate and final results of the MAR steps.
+
+        After every step index in `yield_steps` it yields a dict with `step`, the
+        number of MAR steps done, the partially filled latent `tokens` [b, m*n, c]
+        and `mask` [b, m*n] (1 for tokens still to generate) of the generated
+        images, and `images`, a preview decode of the tokens if `preview` else
+        None. The last item, with `final=True`, holds the decoded `images` (None
+        if not `decode`), and the `tokens`, `mask` and `orders` of all batch rows
+        (including the unconditional ones) and the `generator` to resume from.
+        :param yield_steps: step indices after which to yield intermediate results, all steps by
+            default.
+        :param preview: decode the intermediate tokens, with the `preview_decoder` if the model
+            has one; masked tokens are decoded as zeros.
+        :param decode: decode the images of the final result.
+        :param decode_batch_size: decode in micro-batches of this many images, see `decode`.
+        :param tokens, mask, orders: resume from a partially generated state, e.g. the state
+            returned by another model of the same latent space (see `draft_refine`).
+        :param start_step, stop_step: run only the MAR steps `[start_step, stop_step)` of the
+            `num_iter` step schedule.
+        :param generator: None for the global RNG, a `torch.Generator` for the whole batch, or a
+            list with one `torch.Generator` or int seed per generated image. With one generator per
+            image, the generation order and diffusion noise of an image come from its own stream,
+            so the image does not depend on the rest of the batch.
+        :param cfg_interval: `(lo, hi)` range in which classifier-free guidance is applied. Outside
+            of it only the conditional half of the batch is run. `None` guides every step.
+        :param cfg_interval_type: 'step' for a `[lo, hi)` range of MAR step indices, or 'mask_ratio'
+            for a `[lo, hi]` range of the fraction of tokens still masked before the step.
+        :param dedup_prompts: prefill identical prompt rows only once, see `prefill`.
+        :param prefix_cache: a `PrefixKVCache` shared across calls, see `prefill`.
+        :param diffusion_sampler: sampler of the diffusion head, 'ddpm', 'ddim' or 'dpm_solver'.
+        :param diffusion_steps: number of diffusion steps per MAR step, defaults to the
+            `num_sampling_steps` of the diffusion head.
+        :param llm_refresh_interval: recompute the LLM residual only every k MAR steps and reuse
+            the cached one in between (approximate, DeepCache-style). 1 runs the LLM on every step.
+        :param llm_refresh_threshold: additionally recompute the residual as soon as the fraction of
+            newly visible tokens since the last recompute exceeds this value.
+        """
         bsz = attention_mask.shape[0]
         if cfg != 1.0:
             assert bsz % 2 == 0
+        assert cfg_interval_type in ('step', 'mask_ratio')
+        num_images = bsz // 2 if cfg != 1.0 else bsz
 
         if image_shape is None:
             m = n = int(self.gen_seq_len ** 0.5)
@@ -204,40 +467,89 @@ class Harmon(nn.Module):
         if mask is None:
             mask = torch.ones(bsz, m*n, device=self.device, dtype=self.dtype)
         else:
-            mask = mask.view(bsz, m*n)
-        tokens = torch.zeros(bsz, m*n, self.token_embed_dim,
-                             device=self.device, dtype=self.dtype)
-        orders = self.mar.sample_orders(bsz, seq_len=m*n)
-        if cfg != 1.0:
-            orders[bsz//2:] = orders[:bsz//2]
+            mask = mask.view(bsz, m*n).to(device=self.device, dtype=self.dtype)
+        if tokens is None:
+            tokens = torch.zeros(bsz, m*n, self.token_embed_dim,
+                                 device=self.device, dtype=self.dtype)
+        else:
+            tokens = tokens.view(bsz, m*n, self.token_embed_dim).to(device=self.device, dtype=self.dtype)
+        generator = make_generators(generator, num_images, self.device)
+        if orders is None:
+            orders = self.mar.sample_orders(num_images, seq_len=m*n, generator=generator)
+            if cfg != 1.0:
+                orders = torch.cat([orders, orders])
+        else:
+            orders = orders.to(self.device)
 
-        indices = list(range(num_iter))
+        stop_step = num_iter if stop_step is None else stop_step
+        indices = list(range(start_step, stop_step))
         if progress:
             indices = tqdm(indices)
 
         # past key values can be prepared outside (usually in multi-turn editing)
         if past_key_values is None:
-            output = self.llm_model(inputs_embeds=inputs_embeds,
-                                    attention_mask=None,
-                                    position_ids=None,
-                                    past_key_values=DynamicCache.from_legacy_cache(),
-                                    return_dict=True,
-                                    use_cache=True)
-            past_key_values = output.past_key_values
+            past_key_values = self.prefill(input_ids=input_ids, inputs_embeds=inputs_embeds,
+                                           attention_mask=attention_mask, dedup_prompts=dedup_prompts,
+                                           prefix_cache=prefix_cache)
+        prefix_len = past_key_values[0][0].shape[-2]
+
+        # image tokens of each step go into a preallocated scratch region after the prompt,
+        # instead of being appended to the prompt cache and curtailed afterwards
+        if static_cache:
+            past_key_values = StaticPrefixCache.from_prefix(
+                past_key_values, max_new_tokens=self.mar.buffer_size + m*n)
+
+        # LLM step caching: the LLM residual is only recomputed on refresh steps
+        step_caching = llm_refresh_interval > 1 or llm_refresh_threshold is not None
+        residual_cache = None
+        last_refresh_step = last_refresh_visible = 0
+        # whether the cached residual of the unconditional half is outdated
+        uncond_residual_stale = False
 
         # generate latents
         for step in indices:
             cur_tokens = tokens.clone()
-            x_enc = self.forward_mae_encoder(tokens.view(bsz, m, n, -1),
-                                             mask.to(self.dtype),
-                                             past_key_values=past_key_values,
-                                             # inputs_embeds=inputs_embeds,
-                                             attention_mask=attention_mask)
-            # import pdb; pdb.set_trace()
-            self.curtail_cache(past_key_values, inputs_embeds.shape[1])
-            # import pdb; pdb.set_trace()
+            # guidance interval: outside of it the batch shrinks to the conditional half
+            guided = cfg != 1.0
+            if guided and cfg_interval is not None:
+                lo, hi = cfg_interval
+                if cfg_interval_type == 'step':
+                    guided = lo <= step < hi
+                else:
+                    guided = lo <= int(mask[0].sum()) / (m*n) <= hi
+            rows = bsz if guided or cfg == 1.0 else bsz // 2
+
+            refresh = True
+            if step_caching and residual_cache is not None:
+                num_visible = m*n - int(mask[0].sum())
+                refresh = (step - last_refresh_step >= llm_refresh_interval
+                           or (llm_refresh_threshold is not None
+                               and num_visible - last_refresh_visible > llm_refresh_threshold * m*n)
+                           or (rows == bsz and uncond_residual_stale))
+            if refresh:
+                x_enc, residual = self.forward_mae_encoder(tokens[:rows].view(rows, m, n, -1),
+                                                           mask[:rows].to(self.dtype),
+                                                           return_residual=True,
+                                                           past_key_values=self.select_cache_rows(
+                                                               past_key_values, rows),
+                                                           # inputs_embeds=inputs_embeds,
+                                                           attention_mask=attention_mask[:rows])
+                # import pdb; pdb.set_trace()
+                if not static_cache and rows == bsz:
+                    self.curtail_cache(past_key_values, prefix_len)
+                # import pdb; pdb.set_trace()
+                if step_caching:
+                    visible = torch.cat([self.mar.buffer_mask(rows, mask.dtype, mask.device), mask[:rows]], dim=1) == 0
+                    residual_cache = residual.new_zeros(bsz, self.mar.buffer_size + m*n, residual.shape[-1])
+                    residual_cache[visible.nonzero(as_tuple=True)] = residual.flatten(0, 1)
+                    last_refresh_step, last_refresh_visible = step, m*n - int(mask[0].sum())
+                    uncond_residual_stale = rows < bsz
+            else:
+                x_enc = self.forward_mae_encoder_cached(tokens[:rows].view(rows, m, n, -1),
+                                                        mask[:rows].to(self.dtype), residual_cache[:rows])
 
-            z = self.mar.forward_mae_decoder(x_enc, mask.to(self.dtype), image_shape=(m, n), x_con=x_con)
+            z = self.mar.forward_mae_decoder(x_enc, mask[:rows].to(self.dtype), image_shape=(m, n),
+                                             x_con=x_con if x_con is None else x_con[:rows])
 
             # mask ratio for the next round, following MaskGIT and MAGE.
             mask_ratio = np.cos(math.pi / 2. * (step + 1) / num_iter)
@@ -260,6 +572,7 @@ class Harmon(nn.Module):
             #     mask_to_pred = torch.cat([mask_to_pred, mask_to_pred], dim=0)
 
             # sample token latents for this step
+            mask_to_pred = mask_to_pred[:rows]
             z = z[mask_to_pred.nonzero(as_tuple=True)]
             # cfg schedule follow Muse
             if cfg_schedule == "linear":
@@ -268,7 +581,11 @@ class Harmon(nn.Module):
                 cfg_iter = cfg
             else:
                 raise NotImplementedError
-            sampled_token_latent = self.mar.diffloss.sample(z, temperature, cfg_iter).to(self.dtype)
+            if not guided:
+                cfg_iter = 1.0
+            sampled_token_latent = self.mar.diffloss.sample(
+                z, temperature, cfg_iter, sampler=diffusion_sampler, num_steps=diffusion_steps,
+                generator=generator, group_sizes=len(z) // rows).to(self.dtype)
             # if not cfg == 1.0:
             #     sampled_token_latent, _ = sampled_token_latent.chunk(2, dim=0)  # Remove null class samples
             #     mask_to_pred, _ = mask_to_pred.chunk(2, dim=0)
@@ -278,8 +595,117 @@ class Harmon(nn.Module):
                 cur_tokens[bsz//2:] = cur_tokens[:bsz//2]
             tokens = cur_tokens.clone()
 
-        pred = self.decode(tokens.view(bsz, m, n, -1))
+            if step < stop_step - 1 and (yield_steps is None or step in yield_steps):
+                images = None
+                if preview:
+                    images = self.decode(tokens[:num_images].view(num_images, m, n, -1),
+                                         preview=self.preview_decoder is not None,
+                                         batch_size=decode_batch_size)
+                yield dict(step=step + 1, tokens=tokens[:num_images], mask=mask[:num_images], images=images,
+                           final=False)
+
+        images = None
+        if decode:
+            # the unconditional rows are not decoded
+            images = self.decode(tokens[:num_images].view(num_images, m, n, -1), batch_size=decode_batch_size)
+        yield dict(step=stop_step, tokens=tokens, mask=mask, orders=orders, generator=generator,
+                   images=images, final=True)
+
+    @torch.no_grad()
+    def sample_static(self,
+                      input_ids=None, inputs_embeds=None,
+                      attention_mask=None, num_iter=64, cfg=1.0, cfg_schedule="constant", temperature=1.0,
+                      progress=False, past_key_values=None, image_shape=None, x_con=None,
+                      compile=False, bucket_tokens=False, dedup_prompts=True,
+                      prefix_cache=None, diffusion_sampler='ddpm', diffusion_steps=None, generator=None,
+                      decode_batch_size=None, **kwargs):
+        """Shape-static counterpart of `sample`.
+
+        Masked tokens are hidden by attention masks instead of being dropped, the
+        mask schedule is computed on the host and the tokens to predict at each
+        step are gathered from the generation orders, so every tensor of a MAR
+        step has a fixed shape. Token, mask and KV buffers are allocated once per
+        call and updated in place.
+        :param compile: run the MAR step (MAR encoder, LLM and MAR decoder) and the
+            blocks of the diffusion head as `torch.compile` regions.
+        :param bucket_tokens: pad the number of tokens sampled by the diffusion
+            head at each step to the next power of two, which bounds the number
+            of distinct shapes to log2(m*n).
+        :param dedup_prompts: prefill identical prompt rows only once, see `prefill`.
+        :param prefix_cache: a `PrefixKVCache` shared across calls, see `prefill`.
+        :param diffusion_sampler: sampler of the diffusion head, 'ddpm', 'ddim' or 'dpm_solver'.
+        :param diffusion_steps: number of diffusion steps per MAR step, defaults to the
+            `num_sampling_steps` of the diffusion head.
+        :param generator: per-call or per-image random streams, see `sample_progressive`.
+        :param decode_batch_size: decode in micro-batches of this many images, see `decode`.
+        """
+        bsz = attention_mask.shape[0]
+        if cfg != 1.0:
+            assert bsz % 2 == 0
+
+        if image_shape is None:
+            m = n = int(self.gen_seq_len ** 0.5)
+        else:
+            m, n = image_shape
 
+        mask = torch.ones(bsz, m*n, device=self.device, dtype=self.dtype)
+        tokens = torch.zeros(bsz, m*n, self.token_embed_dim,
+                             device=self.device, dtype=self.dtype)
+        num_images = bsz // 2 if cfg != 1.0 else bsz
+        generator = make_generators(generator, num_images, self.device)
+        orders = self.mar.sample_orders(num_images, seq_len=m*n, generator=generator)
         if cfg != 1.0:
-            pred = pred[:bsz//2]
-        return pred
+            orders = torch.cat([orders, orders])
+        attention_mask = attention_mask.to(device=self.device, dtype=torch.bool)
+
+        if past_key_values is None:
+            past_key_values = self.prefill(input_ids=input_ids, inputs_embeds=inputs_embeds,
+                                           attention_mask=attention_mask, dedup_prompts=dedup_prompts,
+                                           prefix_cache=prefix_cache)
+        past_key_values = StaticPrefixCache.from_prefix(
+            past_key_values, max_new_tokens=self.mar.buffer_size + m*n)
+
+        mar_step = self.mar_step_padded
+        if compile:
+            if getattr(self, '_compiled_mar_step', None) is None:
+                self._compiled_mar_step = torch.compile(self.mar_step_padded, dynamic=False)
+            mar_step = self._compiled_mar_step
+
+        schedule = mask_schedule(m*n, num_iter)
+        if progress:
+            schedule = tqdm(schedule)
+
+        # generate latents
+        for start, end, mask_len in schedule:
+            num_pred = end - start
+            if num_pred == 0:
+                continue
+            z = mar_step(tokens, mask, past_key_values, attention_mask, (m, n), x_con)
+
+            # locations to be predicted in this iteration, in raster order
+            pred_idx = orders[:, start:end].sort(dim=1).values
+            z_idx = pred_idx
+            if bucket_tokens:
+                num_pad = (1 << (num_pred - 1).bit_length()) - num_pred
+                z_idx = torch.cat([pred_idx, pred_idx[:, :1].expand(-1, num_pad)], dim=1)
+            z = z.gather(1, z_idx[..., None].expand(-1, -1, z.shape[-1])).flatten(0, 1)
+
+            # cfg schedule follow Muse
+            if cfg_schedule == "linear":
+                cfg_iter = 1 + (cfg - 1) * (m*n - mask_len) / (m*n)
+            elif cfg_schedule == "constant":
+                cfg_iter = cfg
+            else:
+                raise NotImplementedError
+            sampled_token_latent = self.mar.diffloss.sample(
+                z, temperature, cfg_iter, sampler=diffusion_sampler, num_steps=diffusion_steps,
+                compile=compile, generator=generator, group_sizes=len(z) // bsz).to(self.dtype)
+            sampled_token_latent = sampled_token_latent.view(bsz, -1, self.token_embed_dim)[:, :num_pred]
+
+            tokens.scatter_(1, pred_idx[..., None].expand(-1, -1, self.token_embed_dim), sampled_token_latent)
+            mask.scatter_(1, pred_idx, 0)
+            if cfg != 1.0:
+                tokens[bsz//2:] = tokens[:bsz//2]
+
+        num_images = bsz // 2 if cfg != 1.0 else bsz
+        return self.decode(tokens[:num_images].view(num_images, m, n, -1), batch_size=decode_batch_size)
@@ -6,6 +6,7 @@ from torch.autograd.function import Function
 from mmengine.logging import print_log
 from xtuner.model.utils import guess_load_checkpoint
 from xtuner.utils import IMAGE_TOKEN_INDEX
+from src.datasets.collate_functions import packed_position_ids
 from .harmon import Harmon
 
 
@@ -27,11 +28,18 @@ class HarmonDev(Harmon, BaseModel):
                  pretrained_pth=None,
                  freeze_llm=False,
                  gradient_checkpointing=True,
+                 use_varlen_attn=False,
                  **kwargs
                  ):
         super().__init__(**kwargs)
         self.grad_scale = grad_scale
         self.loss_weights = loss_weights
+        # batches packed into one row by collate_func_und_packed / collate_func_gen_packed,
+        # the samples are kept apart by the varlen attention of flash_attention_2
+        self.use_varlen_attn = use_varlen_attn
+        if use_varlen_attn:
+            assert self.llm.config._attn_implementation == 'flash_attention_2', \
+                'use_varlen_attn requires the flash_attention_2 implementation of the LLM'
 
         if pretrained_pth is not None:
             pretrained_state_dict = guess_load_checkpoint(pretrained_pth)
@@ -58,7 +66,7 @@ class HarmonDev(Harmon, BaseModel):
     def state_dict(self, *args, **kwargs):
         state_dict = super().state_dict(*args, **kwargs)
         state_dict = {k: v for k, v in state_dict.items()
-                      if 'vae.' not in k}
+                      if 'vae.' not in k and 'preview_decoder.' not in k}
 
         return state_dict
 
@@ -68,8 +76,13 @@ class HarmonDev(Harmon, BaseModel):
         return self
 
     def text2image_loss(self, data_dict):
-        x = data_dict['pixel_values'].to(dtype=self.dtype, device=self.device)
-        x = self.encode(x)   # b m n c
+        if data_dict.get('latents') is not None:
+            # pre-encoded by scripts/cache_latents.py, the VAE is not needed
+            x = data_dict['latents'].to(dtype=self.dtype, device=self.device)
+            x = self.latents_to_tokens(x)   # b m n c
+        else:
+            x = data_dict['pixel_values'].to(dtype=self.dtype, device=self.device)
+            x = self.encode(x)   # b m n c
         b, m, n, _ = x.shape
         gt_latents = x.clone().detach().view(b, m*n, -1)
 
@@ -77,18 +90,58 @@ class HarmonDev(Harmon, BaseModel):
         mask = self.mar.random_masking(x.flatten(1, 2), orders)
 
         input_ids = data_dict['input_ids'].to(self.device)
-        attention_mask = data_dict['attention_mask'].to(self.device)
-        x_enc = self.forward_mae_encoder(x, mask, input_ids=input_ids,
-                                         attention_mask=attention_mask)
+        assert ('seq_lengths' in data_dict) == self.use_varlen_attn, \
+            'packed batches (collate_func_gen_packed) require HarmonDev(use_varlen_attn=True) and vice versa'
+        if self.use_varlen_attn:
+            x_enc = self.forward_mae_encoder_packed(x, mask, input_ids=input_ids,
+                                                    seq_lengths=data_dict['seq_lengths'])
+        else:
+            attention_mask = data_dict['attention_mask'].to(self.device)
+            x_enc = self.forward_mae_encoder(x, mask, input_ids=input_ids,
+                                             attention_mask=attention_mask)
         z = self.mar.forward_mae_decoder(x_enc, mask, image_shape=(m, n))
 
         loss = self.mar.forward_loss(z=z, target=gt_latents, mask=mask)
 
         return loss
 
+    def forward_mae_encoder_packed(self, x, mask, input_ids, seq_lengths):
+        """Variant of `forward_mae_encoder` for prompts packed into one row by
+        `collate_func_gen_packed`. Every image is placed right after its own
+        prompt, so the packed row holds no padding."""
+        x_enc, z_enc = self.extract_visual_feature(x, mask=mask)
+        b, l, _ = z_enc.shape
+        text_embeds = self.llm.get_input_embeddings()(input_ids[0]).split(seq_lengths.tolist())
+        inputs_embeds = torch.cat([embeds for sample in zip(text_embeds, z_enc) for embeds in sample])
+
+        seq_lengths = seq_lengths + l
+        position_ids = packed_position_ids(seq_lengths).to(self.device)
+        output = self.llm_model(inputs_embeds=inputs_embeds[None], position_ids=position_ids, return_dict=True)
+
+        # the image tokens end every sample
+        image_positions = torch.cumsum(seq_lengths, dim=0)[:, None] - l + torch.arange(l)
+        z_llm = output.last_hidden_state[0, image_positions.flatten().to(self.device)].view(b, l, -1)
+
+        # move buffers back to the start of the image sequence
+        z_llm = torch.cat([
+            z_llm[:, -self.mar.buffer_size:],
+            z_llm[:, :-self.mar.buffer_size]], dim=1)
+
+        # residual learning
+        x_enc = x_enc + self.proj_out(z_llm)
+
+        return x_enc
+
     def image2text_loss(self, data_dict):
         input_ids = data_dict['input_ids'].to(self.device)
-        attention_mask = data_dict['attention_mask'].to(self.device)
+        assert ('position_ids' in data_dict) == self.use_varlen_attn, \
+            'packed batches (collate_func_und_packed) require HarmonDev(use_varlen_attn=True) and vice versa'
+        if self.use_varlen_attn:
+            attention_mask = None
+            position_ids = data_dict['position_ids'].to(self.device)
+        else:
+            attention_mask = data_dict['attention_mask'].to(self.device)
+            position_ids = None
         labels = data_dict['labels'].to(self.device)
 
         pixel_values = data_dict.get('pixel_values', None)
@@ -116,6 +169,7 @@ class HarmonDev(Harmon, BaseModel):
 
         output = self.llm_model(inputs_embeds=inputs_embeds,
                                 attention_mask=attention_mask,
+                                position_ids=position_ids,
                                 return_dict=True)
 
         last_hidden_state = output.last_hidden_state[:, :-1]
@@ -4,6 +4,7 @@ from torch.utils.checkpoint import checkpoint
 import math
 
 from src.models.mar.diffusion import create_diffusion
+from src.models.random_utils import randn
 
 
 class DiffLoss(nn.Module):
@@ -22,36 +23,95 @@ class DiffLoss(nn.Module):
 
         self.train_diffusion = create_diffusion(timestep_respacing="", noise_schedule="cosine")
         self.gen_diffusion = create_diffusion(timestep_respacing=num_sampling_steps, noise_schedule="cosine")
-
-    def forward(self, target, z, mask=None):
+        self.num_sampling_steps = num_sampling_steps
+        # respaced sampling diffusions for other step counts, see get_gen_diffusion
+        self.gen_diffusions = {}
+
+    def forward(self, target, z, mask=None, num_repeats=1):
+        # every row is trained on num_repeats timesteps, laid out as target.repeat(num_repeats, 1);
+        # the condition z is not repeated, its embedding is broadcast over the repeats in the MLP
+        target = target.repeat(num_repeats, 1)
         t = torch.randint(0, self.train_diffusion.num_timesteps, (target.shape[0],), device=target.device)
         model_kwargs = dict(c=z)
         loss_dict = self.train_diffusion.training_losses(self.net, target, t, model_kwargs)
         loss = loss_dict["loss"]
         if mask is not None:
-            loss = (loss * mask).sum() / mask.sum()
+            loss = (loss.view(num_repeats, -1) * mask).sum() / (mask.sum() * num_repeats)
         return loss.mean()
 
-    def sample(self, z, temperature=1.0, cfg=1.0):
+    def get_gen_diffusion(self, num_steps=None):
+        """The sampling diffusion respaced to `num_steps`, built on first use."""
+        if num_steps is None or str(num_steps) == self.num_sampling_steps:
+            return self.gen_diffusion
+        num_steps = str(num_steps)
+        if num_steps not in self.gen_diffusions:
+            self.gen_diffusions[num_steps] = create_diffusion(timestep_respacing=num_steps,
+                                                              noise_schedule="cosine")
+        return self.gen_diffusions[num_steps]
+
+    def sample(self, z, temperature=1.0, cfg=1.0, sampler='ddpm', num_steps=None, compile=False,
+               generator=None, group_sizes=1):
         # diffusion loss sampling
-        if not cfg == 1.0:
-            noise = torch.randn(z.shape[0] // 2, self.in_channels).cuda()
-            noise = torch.cat([noise, noise], dim=0)
-            model_kwargs = dict(c=z, cfg_scale=cfg)
-            sample_fn = self.net.forward_with_cfg
+        # temperature and cfg can also be given per row, as [N, 1] and [N // 2, 1] tensors;
+        # a tensor cfg always takes the guided path
+        # the condition embedding is computed once for all diffusion steps
+        # generator: None for the global RNG, a torch.Generator, or a list of generators that each
+        # draw the noise of `group_sizes` consecutive rows (of the conditional half with cfg)
+        blocks_fn = None
+        if compile:
+            if getattr(self, '_compiled_blocks', None) is None:
+                self._compiled_blocks = torch.compile(self.net.forward_blocks)
+            blocks_fn = self._compiled_blocks
+        c_emb = self.net.embed_condition(z)
+        guided = torch.is_tensor(cfg) or not cfg == 1.0
+        num_rows = z.shape[0] // 2 if guided else z.shape[0]
+
+        def draw_noise(dtype=torch.float32):
+            # the unconditional half mirrors the conditional one
+            noise = randn((num_rows, self.in_channels), generator=generator, device=z.device,
+                          dtype=dtype, group_sizes=group_sizes)
+            return torch.cat([noise, noise], dim=0) if guided else noise
+
+        noise = draw_noise()
+        if guided:
+            model_kwargs = dict(c_emb=c_emb, cfg_scale=cfg, blocks_fn=blocks_fn,
+                                x_buffer=c_emb.new_empty(z.shape[0], self.net.model_channels))
+            sample_fn = self.net.forward_sample_with_cfg
         else:
-            noise = torch.randn(z.shape[0], self.in_channels).cuda()
-            model_kwargs = dict(c=z)
-            sample_fn = self.net.forward
-
-        sampled_token_latent = self.gen_diffusion.p_sample_loop(
-            sample_fn, noise.shape, noise, clip_denoised=False, model_kwargs=model_kwargs, progress=False,
-            temperature=temperature
-        )
+            model_kwargs = dict(c_emb=c_emb, blocks_fn=blocks_fn)
+            sample_fn = self.net.forward_sample
+        # the global RNG keeps drawing the step noise of all rows at once
+        noise_fn = None if generator is None else (lambda x: draw_noise(x.dtype))
+
+        gen_diffusion = self.get_gen_diffusion(num_steps)
+        if sampler == 'ddpm':
+            sampled_token_latent = gen_diffusion.p_sample_loop(
+                sample_fn, noise.shape, noise, clip_denoised=False, model_kwargs=model_kwargs, progress=False,
+                temperature=temperature, noise_fn=noise_fn
+            )
+        elif sampler == 'ddim':
+            # deterministic samplers: temperature scales the initial noise
+            sampled_token_latent = gen_diffusion.ddim_sample_loop(
+                sample_fn, noise.shape, noise * temperature, clip_denoised=False, model_kwargs=model_kwargs,
+                progress=False, noise_fn=noise_fn
+            )
+        elif sampler == 'dpm_solver':
+            sampled_token_latent = gen_diffusion.dpm_solver_sample_loop(
+                sample_fn, noise.shape, noise * temperature, clip_denoised=False, model_kwargs=model_kwargs,
+                progress=False
+            )
+        else:
+            raise NotImplementedError
 
         return sampled_token_latent
 
 
+def input_dtype(linear):
+    # dynamically quantized linear layers (see cpu_backend) have no float weight and take float32 inputs
+    weight = linear.weight
+    return weight.dtype if isinstance(weight, torch.Tensor) else torch.float32
+
+
 def modulate(x, shift, scale):
     return x * (1 + scale) + shift
 
@@ -60,7 +120,7 @@ class TimestepEmbedder(nn.Module):
     """
     Embeds scalar timesteps into vector representations.
     """
-    def __init__(self, hidden_size, frequency_embedding_size=256):
+    def __init__(self, hidden_size, frequency_embedding_size=256, max_timesteps=1000):
         super().__init__()
         self.mlp = nn.Sequential(
             nn.Linear(frequency_embedding_size, hidden_size, bias=True),
@@ -68,6 +128,10 @@ class TimestepEmbedder(nn.Module):
             nn.Linear(hidden_size, hidden_size, bias=True),
         )
         self.frequency_embedding_size = frequency_embedding_size
+        # sinusoidal embeddings of the integer timesteps [0, max_timesteps), per device.
+        # kept out of the buffers so that they stay float32 and out of the state dict
+        self.max_timesteps = max_timesteps
+        self._embedding_tables = {}
 
     @staticmethod
     def timestep_embedding(t, dim, max_period=10000):
@@ -90,9 +154,20 @@ class TimestepEmbedder(nn.Module):
             embedding = torch.cat([embedding, torch.zeros_like(embedding[:, :1])], dim=-1)
         return embedding
 
+    def embedding_table(self, device):
+        table = self._embedding_tables.get(device)
+        if table is None:
+            table = self.timestep_embedding(torch.arange(self.max_timesteps, device=device),
+                                            self.frequency_embedding_size)
+            self._embedding_tables[device] = table
+        return table
+
     def forward(self, t):
-        t_freq = self.timestep_embedding(t, self.frequency_embedding_size)
-        t_emb = self.mlp(t_freq.to(self.mlp[0].weight.data.dtype))
+        if t.dtype in (torch.int32, torch.int64):
+            t_freq = self.embedding_table(t.device)[t]
+        else:
+            t_freq = self.timestep_embedding(t, self.frequency_embedding_size)
+        t_emb = self.mlp(t_freq.to(input_dtype(self.mlp[0])))
         return t_emb
 
 
@@ -219,25 +294,67 @@ class SimpleMLPAdaLN(nn.Module):
         Apply the model to an input batch.
         :param x: an [N x C] Tensor of inputs.
         :param t: a 1-D batch of timesteps.
-        :param c: conditioning from AR transformer.
+        :param c: conditioning from AR transformer, [N x C] or, shared by the
+                  N // M repeats of x laid out as c.repeat(N // M, 1), [M x C].
         :return: an [N x C] Tensor of outputs.
         """
         # import pdb; pdb.set_trace()
-        x = self.input_proj(x.to(self.input_proj.weight.data.dtype))
+        x = self.input_proj(x.to(input_dtype(self.input_proj)))
         t = self.time_embed(t)
-        c = self.cond_embed(c.to(self.cond_embed.weight.data.dtype))
+        c = self.cond_embed(c.to(input_dtype(self.cond_embed)))
 
-        y = t + c
+        if len(c) != len(t):
+            # broadcast the embedding over the repeats, autograd sums its gradient back
+            y = (t.view(-1, *c.shape) + c).flatten(0, 1)
+        else:
+            y = t + c
 
         if self.grad_checkpointing and not torch.jit.is_scripting():
             for block in self.res_blocks:
                 x = checkpoint(block, x, y)
+            return self.final_layer(x, y)
         else:
-            for block in self.res_blocks:
-                x = block(x, y)
+            return self.forward_blocks(x, y)
 
+    def forward_blocks(self, x, y):
+        for block in self.res_blocks:
+            x = block(x, y)
         return self.final_layer(x, y)
 
+    def embed_condition(self, c):
+        return self.cond_embed(c.to(input_dtype(self.cond_embed)))
+
+    def forward_sample(self, x, t, c_emb, blocks_fn=None):
+        """
+        Sampling counterpart of forward().
+        :param c_emb: the condition embedding from embed_condition(), computed once per diffusion loop.
+        :param blocks_fn: replaces forward_blocks(), e.g. with a compiled version of it.
+        All rows must share the same timestep, as they do in the sampling loops.
+        """
+        x = self.input_proj(x.to(input_dtype(self.input_proj)))
+        y = self.time_embed(t[:1]) + c_emb
+        return (blocks_fn or self.forward_blocks)(x, y)
+
+    def forward_sample_with_cfg(self, x, t, c_emb, cfg_scale, x_buffer=None, blocks_fn=None):
+        """
+        Sampling counterpart of forward_with_cfg(). Both halves share their input, so it
+        is projected once and written to both halves of `x_buffer`.
+        """
+        half = len(x) // 2
+        h = self.input_proj(x[:half].to(input_dtype(self.input_proj)))
+        if x_buffer is None:
+            x_buffer = h.new_empty(len(x), h.shape[-1])
+        x_buffer[:half] = h
+        x_buffer[half:] = h
+        y = self.time_embed(t[:1]) + c_emb
+        model_out = (blocks_fn or self.forward_blocks)(x_buffer, y)
+        eps = model_out[:, :self.in_channels]
+        cond_eps, uncond_eps = eps[:half], eps[half:]
+        half_eps = uncond_eps + cfg_scale * (cond_eps - uncond_eps)
+        eps[:half] = half_eps
+        eps[half:] = half_eps
+        return model_out
+
     def forward_with_cfg(self, x, t, c, cfg_scale):
         half = x[: len(x) // 2]
         combined = torch.cat([half, half], dim=0)
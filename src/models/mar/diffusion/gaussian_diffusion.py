@@ -180,6 +180,7 @@ class GaussianDiffusion:
         # calculations for diffusion q(x_t | x_{t-1}) and others
         self.sqrt_alphas_cumprod = np.sqrt(self.alphas_cumprod)
         self.sqrt_one_minus_alphas_cumprod = np.sqrt(1.0 - self.alphas_cumprod)
+        self.one_minus_alphas_cumprod = 1.0 - self.alphas_cumprod
         self.log_one_minus_alphas_cumprod = np.log(1.0 - self.alphas_cumprod)
         self.sqrt_recip_alphas_cumprod = np.sqrt(1.0 / self.alphas_cumprod)
         self.sqrt_recipm1_alphas_cumprod = np.sqrt(1.0 / self.alphas_cumprod - 1)
@@ -200,6 +201,26 @@ class GaussianDiffusion:
             (1.0 - self.alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - self.alphas_cumprod)
         )
 
+        # (log-)variances of the learned range and fixed large variance types
+        self.log_betas = np.log(betas)
+        self.fixed_large_variance = np.append(self.posterior_variance[1], betas[1:])
+        self.fixed_large_log_variance = np.log(self.fixed_large_variance)
+
+        # device copies of the arrays above, see _extract
+        self._device_tables = {}
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        """
+        Same as _extract_into_tensor() for the schedule array attribute `name`,
+        read from a float32 copy that is moved to the device once and cached.
+        """
+        key = (name, timesteps.device)
+        table = self._device_tables.get(key)
+        if table is None:
+            table = th.from_numpy(getattr(self, name)).to(device=timesteps.device, dtype=th.float32)
+            self._device_tables[key] = table
+        return _broadcast_to(table[timesteps], broadcast_shape)
+
     def q_mean_variance(self, x_start, t):
         """
         Get the distribution q(x_t | x_0).
@@ -207,9 +228,9 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(self.log_one_minus_alphas_cumprod, t, x_start.shape)
+        mean = self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract("log_one_minus_alphas_cumprod", t, x_start.shape)
         return mean, variance, log_variance
 
     def q_sample(self, x_start, t, noise=None):
@@ -225,8 +246,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape) * noise
         )
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
@@ -236,13 +257,11 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
-        )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract("posterior_log_variance_clipped", t, x_t.shape)
         assert (
             posterior_mean.shape[0]
             == posterior_variance.shape[0]
@@ -285,8 +304,8 @@ class GaussianDiffusion:
         if self.model_var_type in [ModelVarType.LEARNED, ModelVarType.LEARNED_RANGE]:
             assert model_output.shape == (B, C * 2, *x.shape[2:])
             model_output, model_var_values = th.split(model_output, C, dim=1)
-            min_log = _extract_into_tensor(self.posterior_log_variance_clipped, t, x.shape)
-            max_log = _extract_into_tensor(np.log(self.betas), t, x.shape)
+            min_log = self._extract("posterior_log_variance_clipped", t, x.shape)
+            max_log = self._extract("log_betas", t, x.shape)
             # The model_var_values is [-1, 1] for [min_var, max_var].
             frac = (model_var_values + 1) / 2
             model_log_variance = frac * max_log + (1 - frac) * min_log
@@ -296,16 +315,16 @@ class GaussianDiffusion:
                 # for fixedlarge, we set the initial (log-)variance like so
                 # to get a better decoder log likelihood.
                 ModelVarType.FIXED_LARGE: (
-                    np.append(self.posterior_variance[1], self.betas[1:]),
-                    np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                    "fixed_large_variance",
+                    "fixed_large_log_variance",
                 ),
                 ModelVarType.FIXED_SMALL: (
-                    self.posterior_variance,
-                    self.posterior_log_variance_clipped,
+                    "posterior_variance",
+                    "posterior_log_variance_clipped",
                 ),
             }[self.model_var_type]
-            model_variance = _extract_into_tensor(model_variance, t, x.shape)
-            model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+            model_variance = self._extract(model_variance, t, x.shape)
+            model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -334,14 +353,14 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t - pred_xstart
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def condition_mean(self, cond_fn, p_mean_var, x, t, model_kwargs=None):
         """
@@ -363,7 +382,7 @@ class GaussianDiffusion:
         Unlike condition_mean(), this instead uses the conditioning strategy
         from Song et al (2020).
         """
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
 
         eps = self._predict_eps_from_xstart(x, t, p_mean_var["pred_xstart"])
         eps = eps - (1 - alpha_bar).sqrt() * cond_fn(x, t, **model_kwargs)
@@ -382,7 +401,8 @@ class GaussianDiffusion:
         denoised_fn=None,
         cond_fn=None,
         model_kwargs=None,
-        temperature=1.0
+        temperature=1.0,
+        noise_fn=None,
     ):
         """
         Sample x_{t-1} from the model at the given timestep.
@@ -397,6 +417,8 @@ class GaussianDiffusion:
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
         :param temperature: temperature scaling during Diff Loss sampling.
+        :param noise_fn: if not None, a function of x that draws the noise of
+            the step, instead of th.randn_like(x).
         :return: a dict containing the following keys:
                  - 'sample': a random sample from the model.
                  - 'pred_xstart': a prediction of x_0.
@@ -409,7 +431,7 @@ class GaussianDiffusion:
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
         )
-        noise = th.randn_like(x)
+        noise = th.randn_like(x) if noise_fn is None else noise_fn(x)
         nonzero_mask = (
             (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
         )  # no noise when t == 0
@@ -431,6 +453,7 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         temperature=1.0,
+        noise_fn=None,
     ):
         """
         Generate samples from the model.
@@ -449,6 +472,8 @@ class GaussianDiffusion:
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
         :param temperature: temperature scaling during Diff Loss sampling.
+        :param noise_fn: if not None, a function of x that draws the noise of
+            each step, see p_sample().
         :return: a non-differentiable batch of samples.
         """
         final = None
@@ -463,6 +488,7 @@ class GaussianDiffusion:
             device=device,
             progress=progress,
             temperature=temperature,
+            noise_fn=noise_fn,
         ):
             final = sample
         return final["sample"]
@@ -479,6 +505,7 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         temperature=1.0,
+        noise_fn=None,
     ):
         """
         Generate samples from the model and yield intermediate samples from
@@ -491,7 +518,7 @@ class GaussianDiffusion:
         if noise is not None:
             img = noise
         else:
-            img = th.randn(*shape).cuda()
+            img = th.randn(*shape, device=device if device is not None else "cuda")
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -501,7 +528,7 @@ class GaussianDiffusion:
             indices = tqdm(indices)
 
         for i in indices:
-            t = th.tensor([i] * shape[0]).cuda()
+            t = th.full((shape[0],), i, device=img.device)
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -512,6 +539,7 @@ class GaussianDiffusion:
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
                     temperature=temperature,
+                    noise_fn=noise_fn,
                 )
                 yield out
                 img = out["sample"]
@@ -526,6 +554,7 @@ class GaussianDiffusion:
         cond_fn=None,
         model_kwargs=None,
         eta=0.0,
+        noise_fn=None,
     ):
         """
         Sample x_{t-1} from the model using DDIM.
@@ -546,15 +575,15 @@ class GaussianDiffusion:
         # in case we used x_start or x_prev prediction.
         eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
 
-        alpha_bar = _extract_into_tensor(self.alphas_cumprod, t, x.shape)
-        alpha_bar_prev = _extract_into_tensor(self.alphas_cumprod_prev, t, x.shape)
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
         sigma = (
             eta
             * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
             * th.sqrt(1 - alpha_bar / alpha_bar_prev)
         )
         # Equation 12.
-        noise = th.randn_like(x)
+        noise = th.randn_like(x) if noise_fn is None else noise_fn(x)
         mean_pred = (
             out["pred_xstart"] * th.sqrt(alpha_bar_prev)
             + th.sqrt(1 - alpha_bar_prev - sigma ** 2) * eps
@@ -593,10 +622,10 @@ class GaussianDiffusion:
         # Usually our model outputs epsilon, but we re-derive it
         # in case we used x_start or x_prev prediction.
         eps = (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x.shape) * x
+            self._extract("sqrt_recip_alphas_cumprod", t, x.shape) * x
             - out["pred_xstart"]
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
-        alpha_bar_next = _extract_into_tensor(self.alphas_cumprod_next, t, x.shape)
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x.shape)
+        alpha_bar_next = self._extract("alphas_cumprod_next", t, x.shape)
 
         # Equation 12. reversed
         mean_pred = out["pred_xstart"] * th.sqrt(alpha_bar_next) + th.sqrt(1 - alpha_bar_next) * eps
@@ -615,6 +644,7 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         eta=0.0,
+        noise_fn=None,
     ):
         """
         Generate samples from the model using DDIM.
@@ -632,6 +662,7 @@ class GaussianDiffusion:
             device=device,
             progress=progress,
             eta=eta,
+            noise_fn=noise_fn,
         ):
             final = sample
         return final["sample"]
@@ -648,6 +679,7 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         eta=0.0,
+        noise_fn=None,
     ):
         """
         Use DDIM to sample from the model and yield intermediate samples from
@@ -658,7 +690,7 @@ class GaussianDiffusion:
         if noise is not None:
             img = noise
         else:
-            img = th.randn(*shape).cuda()
+            img = th.randn(*shape, device=device if device is not None else "cuda")
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -668,7 +700,7 @@ class GaussianDiffusion:
             indices = tqdm(indices)
 
         for i in indices:
-            t = th.tensor([i] * shape[0]).cuda()
+            t = th.full((shape[0],), i, device=img.device)
             with th.no_grad():
                 out = self.ddim_sample(
                     model,
@@ -679,6 +711,133 @@ class GaussianDiffusion:
                     cond_fn=cond_fn,
                     model_kwargs=model_kwargs,
                     eta=eta,
+                    noise_fn=noise_fn,
+                )
+                yield out
+                img = out["sample"]
+
+    def dpm_solver_sample(
+        self,
+        model,
+        x,
+        t,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        prev_out=None,
+    ):
+        """
+        Take a multistep DPM-Solver++(2M) step from x_t to x_{t-1}.
+        The update uses the x_0 prediction of the model, which for an epsilon
+        model with learned variance is derived from the predicted epsilon.
+        :param prev_out: the output of the previous step, or None for the first
+            step, which is then a first-order (DDIM) step.
+        :return: a dict containing the following keys:
+                 - 'sample': the sample at t-1, the x_0 prediction at t == 0.
+                 - 'pred_xstart': a prediction of x_0.
+                 - 'h': the step size in log-SNR, used by the next step.
+        """
+        out = self.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod_prev", t, x.shape)
+        # half log-SNR; alpha_bar_prev is 1 at t == 0, where the x_0 prediction is returned
+        lambda_s = 0.5 * th.log(alpha_bar / (1 - alpha_bar))
+        lambda_t = 0.5 * th.log(alpha_bar_prev / (1 - alpha_bar_prev).clamp(min=1e-20))
+        h = lambda_t - lambda_s
+
+        pred_xstart = out["pred_xstart"]
+        if prev_out is None:
+            denoised = pred_xstart
+        else:
+            r = prev_out["h"] / h
+            denoised = (1 + 0.5 / r) * pred_xstart - 0.5 / r * prev_out["pred_xstart"]
+        sample = (
+            th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar)) * x
+            - th.sqrt(alpha_bar_prev) * th.expm1(-h) * denoised
+        )
+        final_mask = (t == 0).view(-1, *([1] * (len(x.shape) - 1)))
+        sample = th.where(final_mask, pred_xstart, sample)
+        return {"sample": sample, "pred_xstart": pred_xstart, "h": h}
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Generate samples from the model using DPM-Solver++(2M).
+        Same usage as p_sample_loop().
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+        ):
+            final = sample
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+    ):
+        """
+        Use DPM-Solver++(2M) to sample from the model and yield intermediate
+        samples from each timestep.
+        Same usage as p_sample_loop_progressive().
+        """
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device if device is not None else "cuda")
+        indices = list(range(self.num_timesteps))[::-1]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        out = None
+        for i in indices:
+            t = th.full((shape[0],), i, device=img.device)
+            with th.no_grad():
+                out = self.dpm_solver_sample(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                    # the last update, to t == 0, is first order: the step in log-SNR
+                    # is large there and extrapolating the x_0 predictions overshoots
+                    prev_out=out if i > 1 else None,
                 )
                 yield out
                 img = out["sample"]
@@ -872,6 +1031,10 @@ def _extract_into_tensor(arr, timesteps, broadcast_shape):
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
     res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    return _broadcast_to(res, broadcast_shape)
+
+
+def _broadcast_to(res, broadcast_shape):
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
-    return res + th.zeros(broadcast_shape, device=timesteps.device)
+    return res.expand(broadcast_shape)
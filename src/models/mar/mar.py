@@ -12,6 +12,7 @@ from torch.utils.checkpoint import checkpoint
 from timm.models.vision_transformer import Block
 
 from .diffloss import DiffLoss
+from src.models.random_utils import make_generators, rand
 
 
 def mask_by_order(mask_len, order, bsz, seq_len):
@@ -21,6 +22,25 @@ def mask_by_order(mask_len, order, bsz, seq_len):
     return masking
 
 
+def masked_block_forward(block, x, attn_mask):
+    """`timm` Block forward with a key mask on attention. `attn_mask` is a bool
+    [bsz, seq_len] tensor, True for the tokens that may be attended to."""
+    attn = block.attn
+    h = block.norm1(x)
+    bsz, seq_len, embed_dim = h.shape
+    qkv = attn.qkv(h).reshape(bsz, seq_len, 3, attn.num_heads, attn.head_dim).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv.unbind(0)
+    q, k = attn.q_norm(q), attn.k_norm(k)
+    h = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask[:, None, None, :],
+                                       dropout_p=attn.attn_drop.p if attn.training else 0.)
+    h = h.transpose(1, 2).reshape(bsz, seq_len, embed_dim)
+    h = attn.proj_drop(attn.proj(h))
+
+    x = x + block.drop_path1(block.ls1(h))
+    x = x + block.drop_path2(block.ls2(block.mlp(block.norm2(x))))
+    return x
+
+
 class MAR(nn.Module):
     """ Masked Autoencoder with VisionTransformer backbone
     """
@@ -108,11 +128,32 @@ class MAR(nn.Module):
         )
         self.diffusion_batch_mul = diffusion_batch_mul
 
-    def get_encoder_pos_embed(self, h, w):
-        if h == self.seq_h and w == self.seq_w:
-            return self.encoder_pos_embed_learned
-        buffer_pe, image_pe = self.encoder_pos_embed_learned.split(
-            [self.buffer_size, self.seq_len], dim=1)
+        # memoized pos embeds, masks and templates per resolution, see cached_tensor
+        self._shape_cache = {}
+
+    def cached_tensor(self, key, fn, param=None):
+        """Memoize the shape-derived tensor `fn()` under `key`. A tensor derived
+        from `param` is recomputed once `param` changes (in-place updates bump its
+        version, `.to()` replaces its storage) and is not cached at all while
+        autograd needs its graph. Cached tensors are shared, never modify them in
+        place."""
+        stamp = None
+        if param is not None:
+            if param.requires_grad and torch.is_grad_enabled():
+                return fn()
+            stamp = (param._version, param.data_ptr())
+        entry = self._shape_cache.get(key)
+        if entry is None or entry[0] != stamp:
+            entry = self._shape_cache[key] = (stamp, fn())
+        return entry[1]
+
+    def buffer_mask(self, bsz, dtype, device, value=0):
+        """A [bsz, buffer_size] mask filled with `value`."""
+        return self.cached_tensor(('buffer_mask', bsz, value, dtype, device),
+                                  lambda: torch.full((bsz, self.buffer_size), value, dtype=dtype, device=device))
+
+    def interpolate_pos_embed(self, pos_embed, h, w, buffer_size):
+        buffer_pe, image_pe = pos_embed.split([buffer_size, self.seq_len], dim=1)
         image_pe = rearrange(image_pe, 'b (h w) c -> b c h w',
                              h=self.seq_h, w=self.seq_w)
         image_pe = F.interpolate(image_pe, size=(h, w), mode='bilinear')
@@ -120,28 +161,22 @@ class MAR(nn.Module):
 
         return torch.cat([buffer_pe, image_pe], dim=1)
 
-    def get_decoder_pos_embed(self, h, w):
+    def get_pos_embed(self, name, h, w, buffer_size):
+        pos_embed = getattr(self, name)
         if h == self.seq_h and w == self.seq_w:
-            return self.decoder_pos_embed_learned
-        buffer_pe, image_pe = self.decoder_pos_embed_learned.split(
-            [self.buffer_size, self.seq_len], dim=1)
-        image_pe = rearrange(image_pe, 'b (h w) c -> b c h w',
-                             h=self.seq_h, w=self.seq_w)
-        image_pe = F.interpolate(image_pe, size=(h, w), mode='bilinear')
-        image_pe = rearrange(image_pe, 'b c h w -> b (h w) c')
+            return pos_embed
+        return self.cached_tensor((name, h, w, pos_embed.dtype, pos_embed.device),
+                                  lambda: self.interpolate_pos_embed(pos_embed, h, w, buffer_size),
+                                  param=pos_embed)
 
-        return torch.cat([buffer_pe, image_pe], dim=1)
+    def get_encoder_pos_embed(self, h, w):
+        return self.get_pos_embed('encoder_pos_embed_learned', h, w, self.buffer_size)
 
-    def get_diffusion_pos_embed(self, h, w):
-        if h == self.seq_h and w == self.seq_w:
-            return self.diffusion_pos_embed_learned
-        image_pe = self.diffusion_pos_embed_learned
-        image_pe = rearrange(image_pe, 'b (h w) c -> b c h w',
-                             h=self.seq_h, w=self.seq_w)
-        image_pe = F.interpolate(image_pe, size=(h, w), mode='bilinear')
-        image_pe = rearrange(image_pe, 'b c h w -> b (h w) c')
+    def get_decoder_pos_embed(self, h, w):
+        return self.get_pos_embed('decoder_pos_embed_learned', h, w, self.buffer_size)
 
-        return image_pe
+    def get_diffusion_pos_embed(self, h, w):
+        return self.get_pos_embed('diffusion_pos_embed_learned', h, w, 0)
 
     def initialize_weights(self):
         # parameters
@@ -196,17 +231,16 @@ class MAR(nn.Module):
         x = x.reshape(bsz, c, h_ * p, w_ * p)
         return x  # [n, c, h, w]
 
-    def sample_orders(self, bsz, seq_len=None):
+    def sample_orders(self, bsz, seq_len=None, generator=None):
+        """A batch of random generation orders, as the argsort of uniform noise.
+        :param generator: None for the global RNG, a `torch.Generator`, or one
+            generator or int seed per row, see `make_generators`.
+        """
         if seq_len is None:
             seq_len = self.seq_len
-        # generate a batch of random generation orders
-        orders = []
-        for _ in range(bsz):
-            order = np.array(list(range(seq_len)))
-            np.random.shuffle(order)
-            orders.append(order)
-        orders = torch.Tensor(np.array(orders)).to(self.device).long()
-        return orders
+        generator = make_generators(generator, bsz, self.device)
+        orders = rand((bsz, seq_len), generator=generator, device=self.device, group_sizes=1)
+        return orders.argsort(dim=-1)
 
     def random_masking(self, x, orders):
         # generate token mask
@@ -225,8 +259,10 @@ class MAR(nn.Module):
         bsz, seq_len, embed_dim = x.shape
 
         # concat buffer
-        x = torch.cat([x.new_zeros(bsz, self.buffer_size, embed_dim), x], dim=1)
-        mask_with_buffer = torch.cat([mask.new_zeros(x.size(0), self.buffer_size), mask], dim=1)
+        buffer = self.cached_tensor(('buffer_tokens', bsz, embed_dim, x.dtype, x.device),
+                                    lambda: x.new_zeros(bsz, self.buffer_size, embed_dim))
+        x = torch.cat([buffer, x], dim=1)
+        mask_with_buffer = torch.cat([self.buffer_mask(bsz, mask.dtype, mask.device), mask], dim=1)
 
         # random drop class embedding during training
         # if self.training:
@@ -267,10 +303,13 @@ class MAR(nn.Module):
         bsz, seq_len = mask.shape
 
         x = self.decoder_embed(x)
-        mask_with_buffer = torch.cat([torch.zeros(x.size(0), self.buffer_size, device=x.device), mask], dim=1)
+        mask_with_buffer = torch.cat([self.buffer_mask(x.size(0), torch.float32, x.device), mask], dim=1)
 
         # pad mask tokens
-        mask_tokens = self.mask_token.repeat(mask_with_buffer.shape[0], mask_with_buffer.shape[1], 1).to(x.dtype)
+        mask_tokens = self.cached_tensor(
+            ('mask_tokens', *mask_with_buffer.shape, x.dtype, x.device),
+            lambda: self.mask_token.repeat(mask_with_buffer.shape[0], mask_with_buffer.shape[1], 1).to(x.dtype),
+            param=self.mask_token)
 
         if x_con is not None:
             x_after_pad = self.decoder_embed(x_con)
@@ -308,12 +347,82 @@ class MAR(nn.Module):
             x = x + self.get_diffusion_pos_embed(h=h, w=w)
         return x
 
+    def forward_mae_encoder_padded(self, x, mask, class_embedding, image_shape=None):
+        """Shape-static variant of `forward_mae_encoder`. Masked tokens are kept in
+        the sequence and excluded from attention instead of being dropped, so the
+        output is always [bsz, buffer_size + seq_len, embed_dim]. Outputs at the
+        masked positions carry no information."""
+        x = x.to(self.dtype)
+        x = self.z_proj(x)
+        bsz, seq_len, embed_dim = x.shape
+
+        # concat buffer
+        x = torch.cat([class_embedding.view(bsz, -1, embed_dim).expand(-1, self.buffer_size, -1), x], dim=1)
+        visible_with_buffer = torch.cat([self.buffer_mask(bsz, mask.dtype, mask.device, value=1),
+                                         1 - mask], dim=1).bool()
+
+        # encoder position embedding
+        if image_shape is None:
+            x = x + self.encoder_pos_embed_learned
+        else:
+            h, w = image_shape
+            assert h * w == seq_len
+            x = x + self.get_encoder_pos_embed(h=h, w=w)
+        x = self.z_proj_ln(x)
+
+        # apply Transformer blocks
+        for block in self.encoder_blocks:
+            x = masked_block_forward(block, x, visible_with_buffer)
+        x = self.encoder_norm(x)
+
+        return x
+
+    def forward_mae_decoder_padded(self, x, mask, image_shape=None, x_con=None):
+        """Shape-static variant of `forward_mae_decoder` that takes the padded
+        output of `forward_mae_encoder_padded`."""
+        bsz, seq_len = mask.shape
+
+        x = self.decoder_embed(x)
+        mask_with_buffer = torch.cat([self.buffer_mask(bsz, mask.dtype, mask.device), mask], dim=1).bool()
+
+        # pad mask tokens
+        if x_con is not None:
+            pad = self.decoder_embed(x_con)
+        else:
+            pad = self.mask_token.to(x.dtype)
+        x = torch.where(mask_with_buffer[..., None], pad, x)
+
+        # decoder position embedding
+        if image_shape is None:
+            x = x + self.decoder_pos_embed_learned
+        else:
+            h, w = image_shape
+            assert h * w == seq_len
+            x = x + self.get_decoder_pos_embed(h=h, w=w)
+
+        # apply Transformer blocks
+        for block in self.decoder_blocks:
+            x = block(x)
+        x = self.decoder_norm(x)
+
+        x = x[:, self.buffer_size:]
+        if image_shape is None:
+            x = x + self.diffusion_pos_embed_learned
+        else:
+            h, w = image_shape
+            assert h * w == seq_len
+            x = x + self.get_diffusion_pos_embed(h=h, w=w)
+        return x
+
     def mae_decoder_prepare(self, x, mask):
         x = self.decoder_embed(x)
-        mask_with_buffer = torch.cat([torch.zeros(x.size(0), self.buffer_size, device=x.device), mask], dim=1)
+        mask_with_buffer = torch.cat([self.buffer_mask(x.size(0), torch.float32, x.device), mask], dim=1)
 
         # pad mask tokens
-        mask_tokens = self.mask_token.repeat(mask_with_buffer.shape[0], mask_with_buffer.shape[1], 1).to(x.dtype)
+        mask_tokens = self.cached_tensor(
+            ('mask_tokens', *mask_with_buffer.shape, x.dtype, x.device),
+            lambda: self.mask_token.repeat(mask_with_buffer.shape[0], mask_with_buffer.shape[1], 1).to(x.dtype),
+            param=self.mask_token)
         x_after_pad = mask_tokens.clone()
         x_after_pad[(1 - mask_with_buffer).nonzero(as_tuple=True)] = x.reshape(x.shape[0] * x.shape[1], x.shape[2])
 
@@ -340,10 +449,12 @@ class MAR(nn.Module):
 
     def forward_loss(self, z, target, mask):
         bsz, seq_len, _ = target.shape
-        target = target.reshape(bsz * seq_len, -1).repeat(self.diffusion_batch_mul, 1)
-        z = z.reshape(bsz*seq_len, -1).repeat(self.diffusion_batch_mul, 1)
-        mask = mask.reshape(bsz*seq_len).repeat(self.diffusion_batch_mul)
-        loss = self.diffloss(z=z, target=target, mask=mask)
+        target = target.reshape(bsz * seq_len, -1)
+        z = z.reshape(bsz*seq_len, -1)
+        # the loss only covers the masked tokens: pack them over the batch before the diffusion MLP,
+        # rather than computing all tokens and zeroing the visible ones
+        keep = mask.reshape(bsz*seq_len).nonzero(as_tuple=True)[0]
+        loss = self.diffloss(z=z[keep], target=target[keep], num_repeats=self.diffusion_batch_mul)
         return loss
 
     def forward(self, imgs, labels):
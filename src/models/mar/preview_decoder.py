@@ -0,0 +1,53 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class LatentPreviewDecoder(nn.Module):
+    """Cheap latent-to-RGB decoder for previews and thumbnails.
+
+    Maps every latent pixel of an `AutoencoderKL` (kl16: 16 channels at 1/16 of
+    the image resolution) to a `stride x stride` RGB patch, either linearly
+    (`hidden_channels=0`, a 1x1 conv) or with one hidden 3x3 conv that also sees
+    the neighbouring latents. It takes the same unscaled latents as
+    `AutoencoderKL.decode` and is fitted against its outputs with
+    `scripts/fit_preview_decoder.py`.
+    """
+    def __init__(self, embed_dim=16, stride=16, hidden_channels=0, ckpt_path=None):
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.stride = stride
+        out_channels = 3 * stride ** 2
+        if hidden_channels > 0:
+            self.head = nn.Sequential(
+                nn.Conv2d(embed_dim, hidden_channels, kernel_size=3, padding=1),
+                nn.SiLU(),
+                nn.Conv2d(hidden_channels, out_channels, kernel_size=1),
+            )
+        else:
+            self.head = nn.Sequential(nn.Conv2d(embed_dim, out_channels, kernel_size=1))
+        if ckpt_path is not None:
+            self.init_from_ckpt(ckpt_path)
+
+    @property
+    def is_linear(self):
+        return len(self.head) == 1
+
+    def init_from_ckpt(self, path):
+        sd = torch.load(path, map_location="cpu")["model"]
+        self.load_state_dict(sd)
+        print(f"Restored preview decoder from {path}")
+
+    @torch.no_grad()
+    def set_linear(self, weight, bias):
+        """Set the map of a linear decoder, `weight` [embed_dim, 3 * stride**2]
+        and `bias` [3 * stride**2], e.g. from a least-squares fit."""
+        assert self.is_linear
+        conv = self.head[0]
+        conv.weight.copy_(weight.t().reshape(conv.weight.shape))
+        conv.bias.copy_(bias)
+
+    def forward(self, z):
+        # [b, c, h, w] latents -> [b, 3, h * stride, w * stride] images in [-1, 1]
+        x = self.head(z.to(self.head[0].weight.dtype))
+        return F.pixel_shuffle(x, self.stride)
@@ -1,4 +1,7 @@
 # Adopted from LDM's KL-VAE: https://github.com/CompVis/latent-diffusion
+import contextlib
+import math
+
 import torch
 import torch.nn as nn
 
@@ -138,20 +141,12 @@ class AttnBlock(nn.Module):
         k = self.k(h_)
         v = self.v(h_)
 
-        # compute attention
+        # compute attention as a single head over the hw positions with a fused kernel,
+        # which does not materialize the hw x hw attention matrix
         b, c, h, w = q.shape
-        q = q.reshape(b, c, h * w)
-        q = q.permute(0, 2, 1)  # b,hw,c
-        k = k.reshape(b, c, h * w)  # b,c,hw
-        w_ = torch.bmm(q, k)  # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c) ** (-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
-
-        # attend to values
-        v = v.reshape(b, c, h * w)
-        w_ = w_.permute(0, 2, 1)  # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v, w_)  # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b, c, h, w)
+        q, k, v = (t.flatten(2).transpose(1, 2)[:, None] for t in (q, k, v))  # b,1,hw,c
+        h_ = torch.nn.functional.scaled_dot_product_attention(q, k, v)
+        h_ = h_[:, 0].transpose(1, 2).reshape(b, c, h, w)
 
         h_ = self.proj_out(h_)
 
@@ -447,8 +442,68 @@ class DiagonalGaussianDistribution(object):
         return self.mean
 
 
+def _tile_starts(size, tile_size, min_overlap, align):
+    # evenly spread tiles covering [0, size), overlapping by at least min_overlap,
+    # with starts on multiples of align
+    if size <= tile_size:
+        return [0]
+    num_tiles = math.ceil((size - min_overlap) / (tile_size - min_overlap))
+    starts = [round(i * (size - tile_size) / (num_tiles - 1) / align) * align for i in range(num_tiles)]
+    starts[-1] = size - tile_size
+    return starts
+
+
+def _blend_ramp(size, ramp, start_open, end_open, device):
+    # 1 inside, rising linearly over `ramp` at the edges shared with another tile
+    weight = torch.ones(size, device=device)
+    if ramp > 0:
+        ramp_ = (torch.arange(size, device=device) + 0.5) / ramp
+        if start_open:
+            weight = torch.minimum(weight, ramp_)
+        if end_open:
+            weight = torch.minimum(weight, ramp_.flip(0))
+    return weight
+
+
+def blend_tiles(fn, x, tile_size, tile_overlap, scale, align=1):
+    """Apply the spatial map `fn` (e.g. a VAE decoder) to overlapping tiles of
+    x [b, c, h, w], and blend the outputs with weights that ramp linearly over
+    the overlaps, so that the peak memory of `fn` depends on the tile size
+    only. `scale` is the output / input resolution of `fn` and tile starts are
+    kept on multiples of `align` (the input pixels per output pixel when
+    `scale` < 1). Sizes are in input pixels."""
+    assert 0 <= tile_overlap < tile_size, \
+        f'tile_overlap must be in [0, tile_size), got {tile_overlap} and {tile_size}'
+    h, w = x.shape[-2:]
+    tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+    out = weights = None
+    starts_h = _tile_starts(h, tile_h, tile_overlap, align)
+    starts_w = _tile_starts(w, tile_w, tile_overlap, align)
+    ramp = int(tile_overlap * scale)
+    for i in starts_h:
+        for j in starts_w:
+            y = fn(x[..., i:i + tile_h, j:j + tile_w])
+            if out is None:
+                out = y.new_zeros(*y.shape[:2], int(h * scale), int(w * scale), dtype=torch.float32)
+                weights = out.new_zeros(int(h * scale), int(w * scale))
+            weight = (_blend_ramp(y.shape[-2], ramp, i > 0, i < starts_h[-1], y.device)[:, None]
+                      * _blend_ramp(y.shape[-1], ramp, j > 0, j < starts_w[-1], y.device)[None])
+            i_, j_ = int(i * scale), int(j * scale)
+            out[..., i_:i_ + y.shape[-2], j_:j_ + y.shape[-1]] += y.float() * weight
+            weights[i_:i_ + y.shape[-2], j_:j_ + y.shape[-1]] += weight
+    # the blend ramps are positive everywhere, zero weights mean that tiles left pixels uncovered
+    assert (weights > 0).all(), 'the tiles do not cover the whole input'
+    return (out / weights).to(y.dtype)
+
+
 class AutoencoderKL(nn.Module):
-    def __init__(self, embed_dim, ch_mult, use_variational=True, ckpt_path=None):
+    """
+    :param channels_last: run the convolutions in the channels_last memory format.
+    :param autocast_dtype: if set (e.g. torch.bfloat16), encode and decode run under
+        autocast in this dtype, with normalization and softmax kept in float32.
+    """
+    def __init__(self, embed_dim, ch_mult, use_variational=True, ckpt_path=None,
+                 channels_last=False, autocast_dtype=None):
         super().__init__()
         self.encoder = Encoder(ch_mult=ch_mult, z_channels=embed_dim)
         self.decoder = Decoder(ch_mult=ch_mult, z_channels=embed_dim)
@@ -459,6 +514,10 @@ class AutoencoderKL(nn.Module):
         self.embed_dim = embed_dim
         if ckpt_path is not None:
             self.init_from_ckpt(ckpt_path)
+        self.channels_last = channels_last
+        self.autocast_dtype = autocast_dtype
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
 
     def init_from_ckpt(self, path):
         sd = torch.load(path, map_location="cpu")["model"]
@@ -470,17 +529,71 @@ class AutoencoderKL(nn.Module):
         print(msg.unexpected_keys)
         print(f"Restored from {path}")
 
-    def encode(self, x):
-        h = self.encoder(x)
-        moments = self.quant_conv(h)
+    def _inference_context(self, x):
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(x.device.type, dtype=self.autocast_dtype)
+
+    def _memory_format(self, x):
+        if self.channels_last:
+            return x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    @property
+    def stride(self):
+        return 2 ** (self.encoder.num_resolutions - 1)
+
+    def _check_tiling(self, tile_size, tile_overlap):
+        assert tile_size % self.stride == 0 and tile_overlap % self.stride == 0, \
+            f'tile_size and tile_overlap must be multiples of {self.stride}, got {tile_size} and {tile_overlap}'
+        assert 0 <= tile_overlap < tile_size, \
+            f'tile_overlap must be in [0, tile_size), got {tile_overlap} and {tile_size}'
+
+    def _encode_moments(self, x):
+        return self.quant_conv(self.encoder(self._memory_format(x)))
+
+    def _decode(self, z):
+        return self.decoder(self.post_quant_conv(self._memory_format(z)))
+
+    def encode(self, x, tile_size=None, tile_overlap=0):
+        """
+        :param tile_size: encode in overlapping tiles of this many pixels, blended in latent
+            space, which bounds the peak memory for large images.
+        :param tile_overlap: minimum overlap of the tiles in pixels.
+        Both must be multiples of the stride.
+        """
+        if tile_size is not None:
+            self._check_tiling(tile_size, tile_overlap)
+        with self._inference_context(x):
+            if tile_size is None or max(x.shape[-2:]) <= tile_size:
+                moments = self._encode_moments(x)
+            else:
+                moments = blend_tiles(self._encode_moments, x, tile_size, tile_overlap,
+                                      scale=1 / self.stride, align=self.stride)
+        if self.autocast_dtype is not None:
+            moments = moments.to(x.dtype)
         if not self.use_variational:
             moments = torch.cat((moments, torch.ones_like(moments)), 1)
         posterior = DiagonalGaussianDistribution(moments)
         return posterior
 
-    def decode(self, z):
-        z = self.post_quant_conv(z)
-        dec = self.decoder(z)
+    def decode(self, z, tile_size=None, tile_overlap=0):
+        """
+        :param tile_size: decode in overlapping tiles of this many pixels, blended in pixel
+            space, which bounds the peak memory for large images.
+        :param tile_overlap: minimum overlap of the tiles in pixels.
+        Both must be multiples of the stride.
+        """
+        if tile_size is not None:
+            self._check_tiling(tile_size, tile_overlap)
+        with self._inference_context(z):
+            if tile_size is None or max(z.shape[-2:]) * self.stride <= tile_size:
+                dec = self._decode(z)
+            else:
+                dec = blend_tiles(self._decode, z, tile_size // self.stride, tile_overlap // self.stride,
+                                  scale=self.stride)
+        if self.autocast_dtype is not None:
+            dec = dec.to(z.dtype)
         return dec
 
     def forward(self, inputs, disable=True, train=True, optimizer_idx=0):
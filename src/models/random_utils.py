@@ -0,0 +1,43 @@
+import torch
+
+
+def make_generators(generator, num_rows, device):
+    """Normalize the `generator` argument of the sampling functions.
+
+    Returns None (global RNG), a single `torch.Generator` shared by all rows, or
+    a list of `num_rows` generators, one per row. A list may mix generators and
+    int seeds; a seed becomes a new generator on `device`.
+    """
+    if generator is None or isinstance(generator, torch.Generator):
+        return generator
+    generator = list(generator)
+    assert len(generator) == num_rows, f'{len(generator)} generators for {num_rows} rows'
+    return [torch.Generator(device=device).manual_seed(g) if isinstance(g, int) else g
+            for g in generator]
+
+
+def _random(fn, shape, generator, device, dtype, group_sizes):
+    if generator is None:
+        return fn(shape, device=device, dtype=dtype)
+    if isinstance(generator, torch.Generator):
+        return fn(shape, generator=generator, device=generator.device, dtype=dtype).to(device)
+    if isinstance(group_sizes, int):
+        group_sizes = [group_sizes] * len(generator)
+    assert len(group_sizes) == len(generator) and sum(group_sizes) == shape[0]
+    return torch.cat([fn((size, *shape[1:]), generator=g, device=g.device, dtype=dtype).to(device)
+                      for g, size in zip(generator, group_sizes)])
+
+
+def randn(shape, generator=None, device=None, dtype=None, group_sizes=1):
+    """Standard normal noise of `shape`.
+
+    With a list of generators, consecutive groups of `group_sizes` rows (an int,
+    or one size per generator) along the first dim are drawn from the stream of
+    their own generator, so a row does not depend on the other rows of the batch.
+    """
+    return _random(torch.randn, tuple(shape), generator, device, dtype, group_sizes)
+
+
+def rand(shape, generator=None, device=None, dtype=None, group_sizes=1):
+    """Uniform noise on [0, 1) of `shape`, see `randn`."""
+    return _random(torch.rand, tuple(shape), generator, device, dtype, group_sizes)